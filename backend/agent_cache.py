@@ -0,0 +1,171 @@
+from contextvars import ContextVar
+import typing
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from agents import Agent
+from pydantic import BaseModel
+
+from brain import knowledgebase
+from jobs import report_progress
+from storage import UPLOAD_DIR
+from telemetry import agent_span, run_agent
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+AGENT_CACHE_DB = os.environ.get("AGENT_CACHE_DB", os.path.join(UPLOAD_DIR, "agent_cache.db"))
+AGENT_CACHE_TTL = float(os.environ.get("AGENT_CACHE_TTL", 7 * 24 * 3600))
+AGENT_CACHE_MAX_BYTES = int(os.environ.get("AGENT_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+AGENT_CACHE_DISABLED = os.environ.get("AGENT_CACHE_DISABLED", "").lower() in ("1", "true", "yes")
+
+# set for the current flow (e.g. by the no_cache request parameter) to always call the model
+bypass_cache: ContextVar[bool] = ContextVar("bypass_cache", default=False)
+
+
+def cache_key(agent: Agent, input: str, knowledgebase_versions: dict[str, str] | None = None) -> str:
+    """
+    Key of the agent call - the model, the instructions, the tools, the input, the output schema
+    and the versions of the knowledgebase resources read by the tools.
+    Changing any of them (e.g. editing a prompt template or a refresh of the platforms) makes the cached outputs unreachable.
+    """
+    output_schema = (
+        agent.output_type.model_json_schema()
+        if isinstance(agent.output_type, type) and issubclass(agent.output_type, BaseModel)
+        else repr(agent.output_type)
+    )
+    key = {
+        "model": str(agent.model),
+        "instructions": hashlib.sha256(str(agent.instructions).encode()).hexdigest(),
+        "tools": sorted(tool.name for tool in agent.tools),
+        "input": input,
+        "output_schema": output_schema,
+        "knowledgebase": knowledgebase_versions or {},
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+class AgentCache:
+    """
+    Persistent cache of the structured outputs of agent calls.
+    Entries expire after the TTL, the least recently used ones are evicted when the total size
+    of the outputs exceeds max_bytes.
+    """
+    def __init__(
+        self,
+        path: str = AGENT_CACHE_DB,
+        ttl: float = AGENT_CACHE_TTL,
+        max_bytes: int = AGENT_CACHE_MAX_BYTES,
+    ) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # opened lazily, so that importing the module does not create the database
+        if self._connection is None:
+            if directory := os.path.dirname(self.path):
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS agent_responses (
+                    key TEXT PRIMARY KEY,
+                    agent TEXT NOT NULL,
+                    output TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS agent_responses_used_at ON agent_responses (used_at);
+                """
+            )
+            self._connection = connection
+        return self._connection
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT output, created_at FROM agent_responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            output, created_at = row
+            if now - created_at > self.ttl:
+                self.connection.execute("DELETE FROM agent_responses WHERE key = ?", (key,))
+                return None
+            self.connection.execute("UPDATE agent_responses SET used_at = ? WHERE key = ?", (now, key))
+        return output
+
+    def put(self, key: str, agent: str, output: str) -> None:
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO agent_responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, agent, output, len(output), now, now),
+            )
+            self.evict(now)
+
+    def evict(self, now: float) -> None:
+        self.connection.execute("DELETE FROM agent_responses WHERE created_at < ?", (now - self.ttl,))
+        (size,) = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM agent_responses").fetchone()
+        if size <= self.max_bytes:
+            return
+        evicted = 0
+        for key, entry_size in self.connection.execute(
+            "SELECT key, size FROM agent_responses ORDER BY used_at"
+        ).fetchall():
+            if size <= self.max_bytes:
+                break
+            self.connection.execute("DELETE FROM agent_responses WHERE key = ?", (key,))
+            size -= entry_size
+            evicted += 1
+        logger.info(f"Evicted {evicted} cached agent responses")
+
+
+agent_cache = AgentCache()
+
+
+async def run_cached(
+    agent: Agent,
+    input: str,
+    knowledgebase_resources: typing.Sequence[str] = (),
+    **kwargs: typing.Any,
+) -> typing.Any:
+    """
+    run_agent returning the final output, served from the cache when the same call was made before.
+    The tools of the agent must not read any data besides the knowledgebase_resources (e.g. "platforms"),
+    whose current versions are part of the key.
+    Only structured (pydantic) outputs are cached. The cache is skipped when AGENT_CACHE_DISABLED is set
+    or bypass_cache is set for the current flow.
+    """
+    output_type = agent.output_type
+    cacheable = isinstance(output_type, type) and issubclass(output_type, BaseModel)
+    if not cacheable or AGENT_CACHE_DISABLED or bypass_cache.get():
+        return (await run_agent(agent, input, **kwargs)).final_output
+
+    versions = {resource: await knowledgebase.version(resource) for resource in knowledgebase_resources}
+    key = cache_key(agent, input, versions)
+    # the SQLite queries (and the eviction after a put) are run in a thread, not on the event loop
+    if (cached := await asyncio.to_thread(agent_cache.get, key)) is not None:
+        logger.info(f"Using cached response of {agent.name}")
+        report_progress("agent_cache", agent=agent.name, hit=True)
+        with agent_span(agent, cache_hit=True):
+            return output_type.model_validate_json(cached)
+
+    report_progress("agent_cache", agent=agent.name, hit=False)
+    output = (await run_agent(agent, input, **kwargs)).final_output
+    await asyncio.to_thread(agent_cache.put, key, agent.name, output.model_dump_json())
+    return output
@@ -0,0 +1,41 @@
+import typing
+import logging
+import threading
+
+from agents import Agent
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class AgentRegistry:
+    """
+    Agents built once per process and shared by all sessions.
+    An agent keeps no state of a run (that is in the context given to Runner.run and, for instructions
+    depending on the run, rendered from it), so concurrent runs can use the same instance.
+    Agents are built on first use, or all at once by build_all (e.g. at the start of the server).
+    """
+    def __init__(self) -> None:
+        self.factories: dict[str, typing.Callable[[], Agent]] = {}
+        self.agents: dict[str, Agent] = {}
+        self.lock = threading.Lock()
+
+    def register(self, name: str, factory: typing.Callable[[], Agent]) -> None:
+        self.factories[name] = factory
+        self.agents.pop(name, None)
+
+    def get(self, name: str) -> Agent:
+        if (agent := self.agents.get(name)) is not None:
+            return agent
+        with self.lock:
+            if (agent := self.agents.get(name)) is None:
+                agent = self.agents[name] = self.factories[name]()
+                logger.info(f"Built agent {agent.name} for {name}")
+        return agent
+
+    def build_all(self) -> None:
+        for name in self.factories:
+            self.get(name)
+
+
+agent_registry = AgentRegistry()
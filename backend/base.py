@@ -1,8 +1,13 @@
 from abc import ABC, abstractmethod
-from typing import Any, TypeVar, cast
+from typing import Any, TypeVar, cast, get_args
+from dataclasses import dataclass
+import asyncio
 import logging
 from pydantic import BaseModel
 
+from profiling import profile_span, profiled
+from telemetry import telemetry
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -24,6 +29,29 @@ class FlowData(ABC, BaseModel):
             return self.flow_data_name() == other.flow_data_name()
         return False
 
+    def summary(self) -> str:
+        """
+        Short description of the data for logging.
+        Large values are only described by their size, so the cost does not depend on the size of the data.
+        """
+        fields = []
+        for name in type(self).model_fields:
+            value = getattr(self, name)
+            if isinstance(value, (list, tuple, dict, set)):
+                fields.append(f"{name}=<{type(value).__name__} of {len(value)}>")
+            elif isinstance(value, str) and len(value) > 50:
+                fields.append(f"{name}=<str of {len(value)} chars>")
+            else:
+                fields.append(f"{name}={value!r:.50}")
+        return f"{type(self).__name__}({', '.join(fields)})"
+
+    def to_response(self) -> dict:
+        """
+        Representation of the data returned by the state API.
+        Large data types can return only a part of the data and serve the rest on request.
+        """
+        return self.model_dump()
+
 
 class FlowWorker(ABC):
     """
@@ -45,12 +73,91 @@ class FlowWorker(ABC):
     def output_data(self):
         return [t for t in self.run.__annotations__.values()][-1]
 
+    @property
+    def output_types(self) -> set[type[FlowData]]:
+        """
+        FlowData types produced by the worker, flattened from the output annotation
+        (e.g. set[PlatformData | FileData] or set[ParserDefinitionData, ParsedData]).
+        """
+        types = set()
+        pending = [self.output_data]
+        while pending:
+            t = pending.pop()
+            if isinstance(t, type) and issubclass(t, FlowData):
+                types.add(t)
+            else:
+                pending.extend(get_args(t))
+        return types
+
     @abstractmethod
     async def run(self, *args):
         raise NotImplementedError
 
 T = TypeVar("T", bound=FlowData)
 
+class MissingStateError(KeyError):
+    """
+    Raised when some of the requested FlowData types are not present in the state.
+    """
+    def __init__(self, names: list[str]) -> None:
+        super().__init__(names)
+        self.names = names
+
+    def __str__(self) -> str:
+        return f"Missing state: {', '.join(self.names)}"
+
+@dataclass
+class StateEntry:
+    data: FlowData
+    version: int
+
+class StateStore:
+    """
+    Typed store of the FlowData state.
+    Entries are keyed by the FlowData type (one entry per type) and versioned,
+    the version is incremented on every write of the entry.
+    """
+    def __init__(self) -> None:
+        self.entries: dict[type[FlowData], StateEntry] = {}
+
+    def set(self, data: FlowData) -> StateEntry:
+        t = type(data)
+        previous = self.entries.get(t)
+        entry = StateEntry(data=data, version=previous.version + 1 if previous else 1)
+        self.entries[t] = entry
+        return entry
+
+    def load(self, data: FlowData, version: int) -> None:
+        """
+        Restore a previously stored entry with its version (e.g. from persistent storage).
+        """
+        self.entries[type(data)] = StateEntry(data=data, version=version)
+
+    def get(self, t: type[T]) -> T:
+        try:
+            return cast(T, self.entries[t].data)
+        except KeyError:
+            raise MissingStateError([t.flow_data_name()])
+
+    def gather(self, types: list[type[FlowData]]) -> list[FlowData]:
+        """
+        Get the data of all the types, reporting all missing types at once.
+        """
+        missing = [t.flow_data_name() for t in types if t not in self.entries]
+        if missing:
+            raise MissingStateError(missing)
+        return [self.entries[t].data for t in types]
+
+    def version(self, t: type[FlowData]) -> int:
+        entry = self.entries.get(t)
+        return entry.version if entry else 0
+
+    def __contains__(self, t: type[FlowData]) -> bool:
+        return t in self.entries
+
+    def summary(self) -> str:
+        return ", ".join(f"{t.flow_data_name()} v{e.version}" for t, e in self.entries.items())
+
 class Runtime:
     """
     Runtime class to manage the state of the data processing.
@@ -60,28 +167,117 @@ class Runtime:
     The result of the run is used to update current states.
     """
     def __init__(self) -> None:
-        self.state: dict[str, FlowData] = {}
+        self.store = StateStore()
+        self.worker_inputs: dict[str, tuple[int, ...]] = {} # input versions of the last run of each worker
         logging.info("Runtime initialized.")
 
+    @profiled("Runtime.set_state")
     def set_state(self, data: FlowData):
-        self.state[data.flow_data_name()] = data
-        logging.info(f"State set: {data.flow_data_name()}")
-        logging.info(f"Current states: {self.state}")
+        entry = self.store.set(data)
+        logging.info(f"State set: {data.flow_data_name()} v{entry.version} {data.summary()}")
+        logging.debug(f"Current states: {self.store.summary()}")
 
-    def get_state(self, name: str, _: type[T]) -> T:
-        return cast(T, self.state[name])
+    def input_versions(self, worker: FlowWorker) -> tuple[int, ...]:
+        return tuple(self.store.version(t) for t in worker.input_data)
+
+    def is_up_to_date(self, worker: FlowWorker) -> bool:
+        """
+        Check whether the worker already ran with the current versions of all its inputs.
+        """
+        return self.worker_inputs.get(worker.flow_worker_name()) == self.input_versions(worker)
+
+    @profiled("Runtime.get_state")
+    def get_state(self, t: type[T]) -> T:
+        return self.store.get(t)
 
     async def run(self, worker: FlowWorker):
-        logging.info(f"Running {worker.flow_worker_name()}")
-        logging.info(f"This worker needs {worker.input_data} input data.")
-        args = []
+        with profile_span(f"Runtime.run({worker.flow_worker_name()})"):
+            logging.info(f"Running {worker.flow_worker_name()}")
+            logging.info(f"This worker needs {worker.input_data} input data.")
+            args = self.store.gather(worker.input_data)
+
+            with telemetry.span("worker", worker.flow_worker_name()), profile_span("worker.run"):
+                result: set[FlowData] = await worker.run(*args)
+
+            for r in result:
+                self.set_state(r)
+            # inputs rewritten by the worker itself (e.g. PlatformData) do not make it outdated
+            self.worker_inputs[worker.flow_worker_name()] = self.input_versions(worker)
+
+            logging.info(f"Run finished, states: {self.store.summary()}")
+
+    @staticmethod
+    def flow_dependencies(workers: list[FlowWorker]) -> dict[str, set[str]]:
+        """
+        Build the dependency graph of the workers from their input and output annotations.
+        A worker depends on every other worker of the flow producing one of its inputs.
+        Raises ValueError if the dependencies contain a cycle.
+        """
+        dependencies = {
+            worker.flow_worker_name(): {
+                producer.flow_worker_name()
+                for producer in workers
+                if producer is not worker
+                and any(t in producer.output_types for t in worker.input_data)
+            }
+            for worker in workers
+        }
+        # Kahn's algorithm, only to detect cycles
+        remaining = {name: set(deps) for name, deps in dependencies.items()}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Workers {sorted(remaining)} have cyclic dependencies")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return dependencies
 
-        for input in worker.input_data:
-            args.append({t.__class__: t for t in self.state.values()}[input])
+    def check_flow(self, workers: list[FlowWorker]) -> dict[str, set[str]]:
+        """
+        Check that the flow can run with the current state and return its dependencies (see flow_dependencies).
+        Every input of a worker must be in the state or produced by another worker of the flow,
+        an input the worker produces itself (e.g. PlatformData of the platform worker) must be in the state.
+        Raises MissingStateError with all the missing inputs, ValueError for cyclic dependencies.
+        """
+        dependencies = self.flow_dependencies(workers)
+        missing = {
+            t.flow_data_name()
+            for worker in workers
+            for t in worker.input_data
+            if t not in self.store
+            and not any(producer is not worker and t in producer.output_types for producer in workers)
+        }
+        if missing:
+            raise MissingStateError(sorted(missing))
+        return dependencies
 
-        result: set[FlowData] = await worker.run(*args)
+    async def run_flow(self, workers: list[FlowWorker], force: bool = False) -> list[str]:
+        """
+        Run several workers as a dependency graph.
+        Each worker starts as soon as all workers producing its inputs have finished,
+        so independent workers run concurrently.
+        Workers which already ran with the current versions of their inputs are skipped, unless force is set.
+        Returns the names of the workers that were executed.
+        """
+        dependencies = self.check_flow(workers)
+        executed: list[str] = []
+        tasks: dict[str, asyncio.Task] = {}
 
-        for r in result:
-            self.state[r.flow_data_name()] = r
+        async def run_worker(worker: FlowWorker):
+            name = worker.flow_worker_name()
+            await asyncio.gather(*(tasks[d] for d in dependencies[name]))
+            if not force and self.is_up_to_date(worker):
+                logging.info(f"Skipping {name}, inputs did not change")
+                return
+            await self.run(worker)
+            executed.append(name)
 
-        logging.info(f"Run finished, states: {self.state}")
+        for worker in workers:
+            tasks[worker.flow_worker_name()] = asyncio.ensure_future(run_worker(worker))
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            raise errors[0]
+        return executed
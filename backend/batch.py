@@ -0,0 +1,184 @@
+from dataclasses import dataclass, field
+import typing
+import asyncio
+import logging
+import time
+import uuid
+
+from jobs import Job, JobStatus, current_job
+from profiling import current_profile_span, profile_task
+from models import PlatformData
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchItem:
+    """
+    One file (uploaded or attached to a GitLab issue) of a batch, processed in a runtime of its own.
+    A GitLab issue is an item of its own, which resolves the platform of the issue, stores its attachments
+    and adds them to the batch as further items.
+    """
+    source: str
+    index: int = -1  # position in the batch, set when the item is added
+    file_path: str | None = None
+    file_name: str | None = None
+    content_hash: str | None = None
+    gitlab_issue: int | None = None
+    gitlab_attachment: int = 0
+    platform_name: str = ""
+    platform: PlatformData | None = None
+    user_comment: str | None = None
+    job: Job | None = None
+    result: dict = field(default_factory=dict)
+
+    def info(self) -> dict:
+        job = self.job.info() if self.job else {}
+        return {"index": self.index, "source": self.source, **job, "result": self.result}
+
+
+class Batch:
+    """
+    Items processed by a pool of `concurrency` worker tasks.
+    Every item runs as a Job of its own, so a failing item does not stop the others
+    and the progress reporting of the workers works the same as for a single flow.
+    Items may be added while the batch runs (e.g. the attachments of a resolved GitLab issue).
+    """
+    def __init__(self, concurrency: int) -> None:
+        self.id = uuid.uuid4().hex
+        self.items: list[BatchItem] = []
+        self.queue: asyncio.Queue[BatchItem] = asyncio.Queue()
+        self.concurrency = concurrency
+        self.created_at = time.time()
+        self.finished_at: float | None = None
+        self.task: asyncio.Task | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def add(self, item: BatchItem) -> BatchItem:
+        item.index = len(self.items)
+        item.job = Job(session_id=0, name=f"batch:{item.source}")
+        self.items.append(item)
+        self.queue.put_nowait(item)
+        return item
+
+    def metrics(self) -> dict:
+        """
+        Aggregate throughput of the batch.
+        """
+        counts = {status.value: 0 for status in JobStatus}
+        durations = []
+        for item in self.items:
+            job = item.job
+            counts[job.status.value] += 1
+            if job.started_at is not None and job.finished_at is not None:
+                durations.append(job.finished_at - job.started_at)
+        elapsed = (self.finished_at or time.time()) - self.created_at
+        done = counts[JobStatus.SUCCEEDED.value] + counts[JobStatus.FAILED.value]
+        return {
+            "items": len(self.items),
+            **counts,
+            "elapsed": elapsed,
+            "items_per_minute": done / elapsed * 60 if elapsed > 0 else 0.0,
+            "mean_item_seconds": sum(durations) / len(durations) if durations else None,
+            "max_item_seconds": max(durations) if durations else None,
+        }
+
+    def info(self, items: bool = True) -> dict:
+        info = {
+            "batch_id": self.id,
+            "concurrency": self.concurrency,
+            "finished": self.finished,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "metrics": self.metrics(),
+        }
+        if items:
+            info["items"] = [item.info() for item in self.items]
+        return info
+
+
+class BatchManager:
+    """
+    Runs batches in the background. `run_item` processes one item of the batch and returns its result summary,
+    it is called with the job of the item set as the current job.
+    """
+    def __init__(
+        self,
+        run_item: typing.Callable[[Batch, BatchItem], typing.Awaitable[dict]],
+        concurrency: int = 4,
+        keep_finished: int = 100,
+    ) -> None:
+        self.run_item = run_item
+        self.concurrency = concurrency
+        self.keep_finished = keep_finished
+        self.batches: dict[str, Batch] = {}
+
+    def submit(self, items: list[BatchItem], concurrency: int | None = None) -> Batch:
+        batch = Batch(concurrency or self.concurrency)
+        for item in items:
+            batch.add(item)
+        self.batches[batch.id] = batch
+        batch.task = asyncio.create_task(self.execute(batch))
+        self.prune()
+        logger.info(f"Submitted batch {batch.id} of {len(items)} items")
+        return batch
+
+    async def execute(self, batch: Batch) -> None:
+        # the items are profiled on their own, not in the profile of the request submitting the batch
+        current_profile_span.set(None)
+
+        async def worker():
+            # runs until cancelled, as items can be added by the running ones
+            while True:
+                item = await batch.queue.get()
+                try:
+                    await self.process(batch, item)
+                finally:
+                    batch.queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(batch.concurrency)]
+        try:
+            await batch.queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            for item in batch.items:
+                # not started before the batch was cancelled
+                if not item.job.status.finished:
+                    item.job.set_status(JobStatus.CANCELLED)
+            batch.finished_at = time.time()
+            logger.info(f"Batch {batch.id} finished: {batch.metrics()}")
+
+    async def process(self, batch: Batch, item: BatchItem) -> None:
+        job = item.job
+        current_job.set(job)
+        job.set_status(JobStatus.RUNNING)
+        try:
+            async with profile_task(f"batch item {item.source}") as job.profile_id:
+                item.result = await self.run_item(batch, item)
+            job.set_status(JobStatus.SUCCEEDED)
+        except asyncio.CancelledError:
+            job.set_status(JobStatus.CANCELLED)
+            raise
+        except Exception as e:
+            logger.exception(e)
+            job.set_status(JobStatus.FAILED, str(e))
+
+    def get(self, batch_id: str) -> Batch:
+        return self.batches[batch_id]
+
+    def cancel(self, batch_id: str) -> Batch:
+        batch = self.batches[batch_id]
+        if batch.task is not None and not batch.finished:
+            batch.task.cancel()
+        return batch
+
+    def prune(self) -> None:
+        finished = [batch for batch in self.batches.values() if batch.finished]
+        for batch in finished[: max(0, len(finished) - self.keep_finished)]:
+            del self.batches[batch.id]
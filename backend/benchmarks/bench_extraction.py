@@ -0,0 +1,52 @@
+"""
+Benchmark of the sheet text extraction used by FileData.prepare_file.
+Generates workbooks of growing size and reports the extraction time per row,
+which stays constant when the extraction scales linearly.
+
+Run from the backend directory: python -m benchmarks.bench_extraction
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+import openpyxl
+
+from extraction import extract_sheets
+
+
+def generate_workbook(path: str, rows: int, columns: int = 14) -> None:
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Usage")
+    sheet.append(["Title", "ISBN"] + [f"{month:02d}-2024" for month in range(1, columns - 1)])
+    for i in range(rows):
+        sheet.append(
+            [f"Title, part {i}", f"978-{i:09d}"]
+            + [(i * month) % 97 for month in range(1, columns - 1)]
+        )
+    # a second small sheet, so the multi-sheet path is exercised too
+    summary = workbook.create_sheet("Summary")
+    summary.append(["Generated", datetime.date.today()])
+    workbook.save(path)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 25_000, 50_000, 100_000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'rows':>8} {'seconds':>9} {'us/row':>8} {'chars':>12}")
+        for size in args.sizes:
+            path = os.path.join(directory, f"bench_{size}.xlsx")
+            generate_workbook(path, size)
+            start = time.perf_counter()
+            sheets = extract_sheets(path, "xlsx", os.path.basename(path))
+            elapsed = time.perf_counter() - start
+            chars = sum(len(contents) for _, contents in sheets)
+            print(f"{size:>8} {elapsed:>9.2f} {elapsed / size * 1e6:>8.1f} {chars:>12}")
+
+
+if __name__ == "__main__":
+    main()
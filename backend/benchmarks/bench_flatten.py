@@ -0,0 +1,80 @@
+"""
+Benchmark of the flattening of nibbler records done by validation.parse_file.
+Compares the previous DataFrame post-processing (json_normalize and concat per dict column)
+with the single-pass flatten_records on generated records and checks that both give the same table.
+
+Run from the backend directory: python -m benchmarks.bench_flatten
+"""
+import argparse
+import datetime
+import time
+
+import pandas as pd
+from celus_nigiri import CounterRecord
+from celus_nigiri.record import Identifiers
+
+from flatten import flatten_records
+
+
+def generate_records(count: int) -> list[CounterRecord]:
+    records = []
+    for i in range(count):
+        month = i % 12 + 1
+        dimensions = {"Access_Type": "Controlled" if i % 3 else "OA_Gold"}
+        if i % 5 == 0:
+            # a dimension missing in the first record
+            dimensions["YOP"] = str(2000 + i % 20)
+        records.append(
+            CounterRecord(
+                value=i % 97,
+                start=datetime.date(2024, month, 1),
+                end=datetime.date(2024, month, 28),
+                title=f"Title {i // 12}",
+                title_ids=Identifiers(ISBN=f"978-{i // 12:09d}"),
+                dimension_data=dimensions,
+                metric="Total_Item_Requests" if i % 2 else "Unique_Title_Requests",
+            )
+        )
+    return records
+
+
+def legacy_flatten(records: list[CounterRecord]) -> pd.DataFrame:
+    df = pd.DataFrame(records)
+    df = df.drop(columns=["item_ids"], errors="ignore")
+    for col in df.columns:
+        if isinstance(df[col].iloc[0], dict):
+            dict_df = pd.json_normalize(df[col])
+            dict_df.columns = [f"{col}.{k}" for k in dict_df.columns]
+            df = pd.concat([df, dict_df], axis=1)
+            df = df.drop(columns=[col])
+    return df.dropna(axis=1, how="all")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 300_000])
+    args = parser.parse_args()
+
+    print(f"{'records':>8} {'legacy s':>9} {'single-pass s':>14} {'speedup':>8}")
+    for size in args.sizes:
+        records = generate_records(size)
+
+        start = time.perf_counter()
+        legacy = legacy_flatten(records)
+        legacy_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        flattened = pd.DataFrame(flatten_records(records))
+        elapsed = time.perf_counter() - start
+
+        # the legacy path may order the dimension columns differently
+        pd.testing.assert_frame_equal(
+            legacy[sorted(legacy.columns)].fillna(-1),
+            flattened[sorted(flattened.columns)].fillna(-1),
+            check_dtype=False,
+        )
+        print(f"{size:>8} {legacy_elapsed:>9.2f} {elapsed:>14.2f} {legacy_elapsed / elapsed:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+from pydantic import BaseModel
+import httpx
+import typing
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Platform(BaseModel):
+    short_name: str
+    name: str
+    provider: str | None = None
+    url: str | None = None
+
+class ParserDefinitionAPI(BaseModel):
+    parser_name: str
+    platforms: typing.List[str]
+
+
+class BrainMetric(BaseModel):
+    short_name: str
+    aliases: typing.List[str]
+
+class BrainDimension(BaseModel):
+    short_name: str
+    aliases: typing.List[str]
+
+class BrainClient():
+    """
+    Async client for the Brain knowledgebase API.
+    All requests share one pool of keep-alive connections, the number of requests
+    in flight is bounded and failed requests (connection errors, 429 and 5xx responses)
+    are retried with exponential backoff.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        timeout: float = 10.0,
+        max_connections: int = 10,
+        max_concurrency: int = 4,
+        retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.token = os.environ.get('BRAIN_TOKEN')
+        self.base_url = "https://brain.celus.net/knowledgebase"
+        self.timeout = httpx.Timeout(timeout, connect=5.0)
+        self.limits = httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_connections
+        )
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # created lazily, so that the pool is bound to the running event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Token {self.token}"},
+                timeout=self.timeout,
+                limits=self.limits,
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def retry_delay(self, attempt: int, response: httpx.Response | None = None) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2 ** attempt * (1 + random.random())
+
+    async def request(self, path: str, headers: dict[str, str]) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            response = None
+            try:
+                async with self.semaphore:
+                    response = await self.client.get(path, headers=headers)
+                if response.status_code not in self.RETRY_STATUSES or attempt == self.retries:
+                    return response
+                logger.warning(f"Brain responded {response.status_code} for {path}, retrying")
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Brain request {path} failed ({e!r}), retrying")
+            await asyncio.sleep(self.retry_delay(attempt, response))
+        raise AssertionError("unreachable")
+
+    async def fetch(self, resource: str, etag: str | None = None) -> tuple[list | None, str | None]:
+        """
+        Fetch a knowledgebase resource (e.g. metrics, platforms).
+        When etag is given, the request is conditional and (None, etag) is returned
+        if the resource has not changed since.
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        response = await self.request(f"/{resource}/", headers)
+        if response.status_code == 304:
+            return None, etag
+        response.raise_for_status()
+        return response.json(), response.headers.get("ETag")
+
+    async def get_metrics(self) -> typing.List[BrainMetric]:
+        metrics, _ = await self.fetch("metrics")
+        return [BrainMetric.model_validate(m) for m in metrics]
+
+    async def get_dimensions(self) -> typing.List[BrainDimension]:
+        dimensions, _ = await self.fetch("dimensions")
+        return [BrainDimension.model_validate(d) for d in dimensions]
+
+
+@dataclass
+class CacheEntry:
+    """
+    Cached content of one knowledgebase resource.
+    Fetched_at is a wall clock timestamp, so that it stays meaningful in the on-disk snapshot.
+    """
+    items: list
+    etag: str | None
+    fetched_at: float
+    digest: str | None = None  # hash of the items, computed on first use
+
+    def version(self) -> str:
+        if self.digest is None:
+            items = [item.model_dump(mode="json") for item in self.items]
+            self.digest = hashlib.sha256(json.dumps(items, sort_keys=True).encode()).hexdigest()
+        return self.digest
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+class KnowledgebaseCache:
+    """
+    Shared in-memory cache of the Brain knowledgebase (metrics, dimensions, platforms and parsers).
+    Each resource has its own TTL. Stale entries are still served, while they are
+    revalidated in the background using conditional requests (ETag), so the callers
+    never wait for Brain once the resource has been loaded.
+    The cache can optionally be persisted to a JSON snapshot, which is loaded on startup.
+    """
+    RESOURCES: dict[str, type[BaseModel]] = {
+        "metrics": BrainMetric,
+        "dimensions": BrainDimension,
+        "platforms": Platform,
+        "parsers": ParserDefinitionAPI,
+    }
+    DEFAULT_TTLS: dict[str, float] = {
+        "metrics": 3600,
+        "dimensions": 3600,
+        "platforms": 900,
+        "parsers": 900,
+    }
+
+    def __init__(
+        self,
+        client: BrainClient | None = None,
+        ttls: dict[str, float] | None = None,
+        snapshot_path: str | None = None,
+        refresh_interval: float = 60,
+    ) -> None:
+        self.client = client or BrainClient()
+        self.ttls = {**self.DEFAULT_TTLS, **(ttls or {})}
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.entries: dict[str, CacheEntry] = {}
+        self.locks = {resource: asyncio.Lock() for resource in self.RESOURCES}
+        self.pending: dict[str, asyncio.Task] = {}
+        self.refresher: asyncio.Task | None = None
+        self.load_snapshot()
+
+    def is_stale(self, resource: str) -> bool:
+        entry = self.entries.get(resource)
+        return entry is None or entry.age() >= self.ttls[resource]
+
+    async def get(self, resource: str) -> list:
+        """
+        Get the cached items of the resource.
+        Only the very first load waits for Brain, stale entries are refreshed in the background.
+        """
+        entry = self.entries.get(resource)
+        if entry is None:
+            entry = await self.refresh(resource)
+        elif self.is_stale(resource):
+            self.schedule_refresh(resource)
+        return entry.items
+
+    async def version(self, resource: str) -> str:
+        """
+        Hash of the cached items of the resource, it changes only when a refresh brings different items
+        (unlike the ETag, which Brain may not send). Used to invalidate results derived from the resource.
+        """
+        await self.get(resource)
+        return self.entries[resource].version()
+
+    def schedule_refresh(self, resource: str) -> None:
+        if resource in self.pending:
+            return
+        task = asyncio.create_task(self.refresh(resource))
+        self.pending[resource] = task
+        task.add_done_callback(lambda t: self._refresh_done(resource, t))
+
+    def _refresh_done(self, resource: str, task: asyncio.Task) -> None:
+        self.pending.pop(resource, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Background refresh of {resource} failed: {task.exception()}")
+
+    async def refresh(self, resource: str) -> CacheEntry:
+        """
+        Revalidate the resource against Brain.
+        Concurrent refreshes of the same resource are coalesced into one request.
+        """
+        async with self.locks[resource]:
+            if not self.is_stale(resource):
+                return self.entries[resource]
+            entry = self.entries.get(resource)
+            payload, etag = await self.client.fetch(resource, entry.etag if entry else None)
+            if payload is None:
+                logger.info(f"Knowledgebase {resource} not modified")
+                entry.etag = etag
+                entry.fetched_at = time.time()
+            else:
+                model = self.RESOURCES[resource]
+                entry = CacheEntry(
+                    items=[model.model_validate(item) for item in payload],
+                    etag=etag,
+                    fetched_at=time.time(),
+                )
+                self.entries[resource] = entry
+                logger.info(f"Knowledgebase {resource} refreshed, {len(entry.items)} items")
+            await asyncio.to_thread(self.save_snapshot)
+            return entry
+
+    async def refresh_loop(self) -> None:
+        while True:
+            for resource in self.RESOURCES:
+                if self.is_stale(resource):
+                    try:
+                        await self.refresh(resource)
+                    except Exception as e:
+                        logger.warning(f"Refresh of {resource} failed, serving cached data: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self) -> None:
+        """Start the periodic background refresh, which also warms up the cache."""
+        if self.refresher is None:
+            self.refresher = asyncio.create_task(self.refresh_loop())
+
+    async def stop(self) -> None:
+        tasks = [t for t in [self.refresher, *self.pending.values()] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.refresher = None
+        await self.client.close()
+
+    def load_snapshot(self) -> None:
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return
+        try:
+            with open(self.snapshot_path, "r") as f:
+                snapshot = json.load(f)
+            for resource, data in snapshot.items():
+                model = self.RESOURCES.get(resource)
+                if model is None:
+                    continue
+                self.entries[resource] = CacheEntry(
+                    items=[model.model_validate(item) for item in data["items"]],
+                    etag=data.get("etag"),
+                    fetched_at=data["fetched_at"],
+                )
+            logger.info(f"Knowledgebase snapshot loaded from {self.snapshot_path}")
+        except Exception as e:
+            logger.warning(f"Could not load knowledgebase snapshot: {e}")
+
+    def save_snapshot(self) -> None:
+        if not self.snapshot_path:
+            return
+        snapshot = {
+            resource: {
+                "items": [item.model_dump() for item in entry.items],
+                "etag": entry.etag,
+                "fetched_at": entry.fetched_at,
+            }
+            for resource, entry in self.entries.items()
+        }
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.snapshot_path)
+
+
+knowledgebase = KnowledgebaseCache(snapshot_path=os.environ.get("BRAIN_CACHE_SNAPSHOT"))
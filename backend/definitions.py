@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from layout import similarity
+from storage import UPLOAD_DIR
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFINITIONS_DB = os.environ.get("PARSER_DEFINITIONS_DB", os.path.join(UPLOAD_DIR, "parser_definitions.db"))
+MIN_SIMILARITY = float(os.environ.get("PARSER_EXAMPLES_MIN_SIMILARITY", 0.3))
+
+
+class DefinitionCache:
+    """
+    Persistent cache of validated parser definitions, keyed by the layout fingerprint of the file
+    (see layout.layout_fingerprint).
+    A definition is only stored after it parsed its file successfully, it is still validated
+    against every new file before use.
+    The layout features of the files are stored as well, so that the definitions of similar
+    (not identical) layouts can be found and offered to the agent as examples.
+    """
+    def __init__(self, path: str = DEFINITIONS_DB) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self._connection: sqlite3.Connection | None = None
+        self._features: dict[str, frozenset[str]] | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # opened lazily, so that importing the module does not create the database
+        if self._connection is None:
+            if directory := os.path.dirname(self.path):
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS parser_definitions (
+                    fingerprint TEXT PRIMARY KEY,
+                    definition TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS layout_features (
+                    fingerprint TEXT PRIMARY KEY REFERENCES parser_definitions(fingerprint) ON DELETE CASCADE,
+                    features TEXT NOT NULL
+                );
+                """
+            )
+            self._connection = connection
+        return self._connection
+
+    def get(self, fingerprint: str) -> str | None:
+        """
+        The JSON of the definition stored for the fingerprint, None on a miss.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT definition FROM parser_definitions WHERE fingerprint = ?", (fingerprint,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def hit(self, fingerprint: str) -> None:
+        with self.lock:
+            self.connection.execute(
+                "UPDATE parser_definitions SET hits = hits + 1, used_at = ? WHERE fingerprint = ?",
+                (time.time(), fingerprint),
+            )
+
+    def put(self, fingerprint: str, definition: str, features: set[str] | None = None) -> None:
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                """
+                INSERT INTO parser_definitions (fingerprint, definition, created_at, used_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (fingerprint) DO UPDATE SET definition = excluded.definition, used_at = excluded.used_at
+                """,
+                (fingerprint, definition, now, now),
+            )
+            if features is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO layout_features (fingerprint, features) VALUES (?, ?)",
+                    (fingerprint, json.dumps(sorted(features))),
+                )
+                if self._features is not None:
+                    self._features[fingerprint] = frozenset(features)
+        logger.info(f"Stored parser definition for layout {fingerprint[:12]}")
+
+    def features(self) -> dict[str, frozenset[str]]:
+        """
+        Layout features of all stored definitions, loaded once and kept in memory.
+        """
+        with self.lock:
+            if self._features is None:
+                rows = self.connection.execute("SELECT fingerprint, features FROM layout_features").fetchall()
+                self._features = {fingerprint: frozenset(json.loads(features)) for fingerprint, features in rows}
+            return self._features
+
+    def similar(
+        self,
+        features: set[str],
+        k: int = 3,
+        min_similarity: float = MIN_SIMILARITY,
+        exclude: str | None = None,
+    ) -> list[tuple[float, str]]:
+        """
+        The k definitions of the layouts most similar to the features, as (similarity, definition JSON) pairs,
+        most similar first. Layouts less similar than min_similarity are left out.
+        """
+        scored = sorted(
+            (
+                (similarity(features, stored), fingerprint)
+                for fingerprint, stored in self.features().items()
+                if fingerprint != exclude
+            ),
+            reverse=True,
+        )
+        result = []
+        for score, fingerprint in scored[:k]:
+            if score < min_similarity:
+                break
+            if (definition := self.get(fingerprint)) is not None:
+                result.append((score, definition))
+        return result
+
+
+definition_cache = DefinitionCache()
@@ -0,0 +1,163 @@
+import typing
+import gzip
+import logging
+import os
+import tempfile
+import threading
+
+import pandas as pd
+
+from models import ParsedData
+from storage import UPLOAD_DIR
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # optional, only needed for the binary formats
+    pyarrow = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.path.join(UPLOAD_DIR, "exports")
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", 50_000))
+
+FORMATS = {
+    # format: (file extension, media type)
+    "csv.gz": ("csv.gz", "application/gzip"),
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+    "feather": ("feather", "application/vnd.apache.arrow.file"),
+}
+ARROW_FORMATS = {"parquet", "feather"}
+
+
+class ExportError(Exception):
+    pass
+
+
+def iter_chunks(parsed_data: ParsedData, chunk_rows: int) -> typing.Iterator[dict[str, list]]:
+    """
+    Iterate over the parsed data in chunks of rows, each chunk is a dict of column slices.
+    """
+    fields = [col["field"] for col in parsed_data.columns]
+    for start in range(0, parsed_data.row_count, chunk_rows):
+        yield {name: parsed_data.data[name][start:start + chunk_rows] for name in fields}
+
+
+def arrow_schema(parsed_data: ParsedData) -> tuple["pyarrow.Schema", set[str]]:
+    """
+    Arrow schema of the parsed data, inferred from all values of each column, so that all chunks share it.
+    Columns mixing several types (other than ints and floats) are exported as text, their names are returned as the second item.
+    """
+    fields = []
+    as_text = set()
+    for col in parsed_data.columns:
+        name = col["field"]
+        values = [value for value in parsed_data.data[name] if value is not None]
+        kinds = {type(value) for value in values}
+        if len(kinds) > 1 and not kinds <= {int, float}:
+            type_ = pyarrow.string()
+            as_text.add(name)
+        else:
+            type_ = pyarrow.infer_type(values) if values else pyarrow.null()
+        fields.append(pyarrow.field(name, type_))
+    return pyarrow.schema(fields), as_text
+
+
+def write_csv_gz(parsed_data: ParsedData, path: str, chunk_rows: int) -> None:
+    fields = [col["field"] for col in parsed_data.columns]
+    with gzip.open(path, "wt", newline="", compresslevel=6) as file:
+        pd.DataFrame(columns=fields).to_csv(file, index=False)
+        for chunk in iter_chunks(parsed_data, chunk_rows):
+            pd.DataFrame(chunk, columns=fields).to_csv(file, header=False, index=False)
+
+
+def write_arrow(parsed_data: ParsedData, path: str, format: str, chunk_rows: int) -> None:
+    schema, as_text = arrow_schema(parsed_data)
+    if format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(path, schema, compression="zstd")
+    else:
+        # Feather V2 is the Arrow IPC file format
+        writer = pyarrow.ipc.new_file(path, schema, options=pyarrow.ipc.IpcWriteOptions(compression="zstd"))
+    with writer:
+        for chunk in iter_chunks(parsed_data, chunk_rows):
+            arrays = []
+            for field in schema:
+                values = chunk[field.name]
+                if field.name in as_text:
+                    values = [None if value is None else str(value) for value in values]
+                arrays.append(pyarrow.array(values, type=field.type))
+            writer.write_batch(pyarrow.record_batch(arrays, schema=schema))
+
+
+class ParsedDataExporter:
+    """
+    Writes the parsed data into files on demand.
+    An export is identified by the session, the version of the parsed data and the format,
+    so repeated downloads (e.g. resumed by range requests) reuse the written file.
+    Only exports written by this process are reused, the files of the previous runs are overwritten.
+    The data is written in chunks of rows, so no full copy of the table is created on the way.
+    """
+    def __init__(self, directory: str = EXPORT_DIR, chunk_rows: int = EXPORT_CHUNK_ROWS) -> None:
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        self.exports: dict[tuple[int, int, str], str] = {}
+        self.locks: dict[tuple[int, int, str], threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def check_format(self, format: str) -> None:
+        if format not in FORMATS:
+            raise ExportError(f"Unknown export format {format}, use one of: {', '.join(FORMATS)}")
+        if format in ARROW_FORMATS and pyarrow is None:
+            raise ExportError(f"Export to {format} requires pyarrow, install it with: pip install pyarrow")
+
+    def export(self, parsed_data: ParsedData, session_id: int, version: int, format: str) -> str:
+        """
+        Export the parsed data in the format and return the path of the file.
+        Raises ExportError for unknown or unavailable formats.
+        """
+        self.check_format(format)
+        key = (session_id, version, format)
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            path = self.exports.get(key)
+            if path and os.path.exists(path):
+                return path
+
+            os.makedirs(self.directory, exist_ok=True)
+            extension, _ = FORMATS[format]
+            path = os.path.join(self.directory, f"parsed_{session_id}_v{version}.{extension}")
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            os.close(fd)
+            try:
+                if format == "csv.gz":
+                    write_csv_gz(parsed_data, tmp_path, self.chunk_rows)
+                else:
+                    write_arrow(parsed_data, tmp_path, format, self.chunk_rows)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            logger.info(f"Exported {parsed_data.row_count} rows to {path} ({os.path.getsize(path)} bytes)")
+            with self.lock:
+                self.exports[key] = path
+        self.remove_outdated(session_id, version)
+        return path
+
+    def remove_outdated(self, session_id: int, version: int) -> None:
+        """
+        Remove the exports of older versions of the parsed data of the session.
+        """
+        with self.lock:
+            outdated = [key for key in self.exports if key[0] == session_id and key[1] < version]
+            for key in outdated:
+                path = self.exports.pop(key)
+                self.locks.pop(key, None)
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+exporter = ParsedDataExporter()
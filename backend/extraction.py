@@ -0,0 +1,146 @@
+from collections import OrderedDict
+import typing
+import csv
+import io
+import os
+import threading
+import openpyxl
+
+EMPTY_ROW = "empty-row"  # marker keeping the empty rows visible (and countable) in the text
+
+
+def cell_text(value: typing.Any) -> str:
+    """
+    Text of a single cell.
+    Line breaks inside the cell are replaced by spaces, so that every row stays on exactly one line
+    and the row coordinates can be read off the line numbers.
+    """
+    if value is None:
+        return ""
+    text = value if isinstance(value, str) else str(value)
+    if "\n" in text or "\r" in text:
+        text = text.replace("\r\n", " ").replace("\n", " ").replace("\r", " ")
+    return text
+
+
+def iter_csv_rows(path: str) -> typing.Iterator[list[str]]:
+    with open(path, "r", newline="", errors="replace") as file:
+        yield from csv.reader(file)
+
+
+def iter_xlsx_sheets(path: str) -> typing.Iterator[tuple[str, typing.Iterator[tuple]]]:
+    """
+    Iterate over the sheets of the workbook, yielding the sheet name and a lazy iterator of its rows.
+    The workbook is read in read-only (streaming) mode, the rows of a sheet must be consumed
+    before moving to the next sheet.
+    """
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        for sheet in workbook.worksheets:
+            # For some reason in it necessary to reset dimension for some files
+            # which display that only a single cell is present in the data
+            if sheet.calculate_dimension(force=True) == "A1:A1":
+                sheet.reset_dimensions()
+            yield sheet.title, sheet.iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def render_rows(
+    rows: typing.Iterable[typing.Sequence[typing.Any]],
+    trim_columns: bool = True,
+    trim_rows: bool = True,
+) -> str:
+    """
+    Render the rows as CSV text, one line per row, with proper quoting.
+    Empty rows are rendered as EMPTY_ROW.
+    trim_columns drops the empty cells at the end of each row, trim_rows drops the empty rows
+    at the end of the sheet. Only trailing regions are trimmed, so the coordinates of all cells are kept.
+    Runs in a single pass and linear time, the text is built in one buffer.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    pending_empty = 0
+    for row in rows:
+        cells = [cell_text(value) for value in row]
+        end = len(cells)
+        while end and not cells[end - 1]:
+            end -= 1
+        if not end:
+            pending_empty += 1
+            continue
+        # empty rows are written only once a non-empty row follows
+        if pending_empty:
+            buffer.write(f"{EMPTY_ROW}\n" * pending_empty)
+            pending_empty = 0
+        writer.writerow(cells[:end] if trim_columns else cells)
+    if not trim_rows:
+        buffer.write(f"{EMPTY_ROW}\n" * pending_empty)
+    return buffer.getvalue()
+
+
+def extract_sheets(
+    path: str,
+    format: str,
+    name: str,
+    trim_columns: bool = True,
+    trim_rows: bool = True,
+) -> list[tuple[str, str]]:
+    """
+    Extract the text of all sheets of the file as (sheet name, CSV text) pairs.
+    A CSV file is a single sheet called by the file name.
+    """
+    if format == "csv":
+        return [(name, render_rows(iter_csv_rows(path), trim_columns, trim_rows))]
+    if format == "xlsx":
+        return [
+            (sheet_name, render_rows(rows, trim_columns, trim_rows))
+            for sheet_name, rows in iter_xlsx_sheets(path)
+        ]
+    return []
+
+
+class SheetsCache:
+    """
+    LRU cache of extracted sheets, bounded by the total number of characters of the cached sheets.
+    Keys identify the file content and format (see content_key), so the same file prepared
+    by several sessions or re-validated several times is extracted only once.
+    """
+    def __init__(self, max_chars: int) -> None:
+        self.max_chars = max_chars
+        self.size = 0
+        self.entries: OrderedDict[tuple, tuple[list, int]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> list | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: tuple, sheets: list, size: int) -> None:
+        if size > self.max_chars:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (sheets, size)
+            self.size += size
+            while self.size > self.max_chars:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+
+def content_key(path: str) -> tuple:
+    """
+    Key identifying the file content - the path with the size and modification time of the file.
+    Derived from the stored file only, never from data sent by the clients (e.g. a claimed content hash),
+    uploads are content-addressed, so the path of an upload already identifies its content.
+    """
+    stat = os.stat(path)
+    return ("file", os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+sheets_cache = SheetsCache(max_chars=int(os.environ.get("SHEETS_CACHE_CHARS", 200_000_000)))
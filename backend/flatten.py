@@ -0,0 +1,64 @@
+from operator import attrgetter
+import dataclasses
+import typing
+
+from celus_nigiri import CounterRecord
+
+SCALAR_FIELDS = (
+    "value",
+    "start",
+    "end",
+    "title",
+    "item",
+    "item_publication_date",
+    "item_authors",
+    "metric",
+    "organization",
+)
+IDENTIFIER_FIELDS = ("DOI", "ISBN", "Print_ISSN", "Online_ISSN", "Proprietary", "URI")
+
+
+def flatten_records(records: typing.Iterable[CounterRecord]) -> dict[str, list]:
+    """
+    Flatten the nibbler records into columns in a single pass.
+    Title identifiers become title_ids.<kind> columns and dimensions become dimension_data.<name> columns,
+    the dimension names are collected from all records (missing values are None).
+    Item identifiers are dropped, as well as the columns without any value.
+    """
+    get_scalars = attrgetter(*SCALAR_FIELDS)
+    get_identifiers = attrgetter(*IDENTIFIER_FIELDS)
+    scalars = []
+    identifiers = []
+    dimensions: dict[str, list] = {}
+    count = 0
+    for record in records:
+        scalars.append(get_scalars(record))
+        identifiers.append(get_identifiers(record.title_ids))
+        for name, value in record.dimension_data.items():
+            column = dimensions.get(name)
+            if column is None:
+                column = dimensions[name] = []
+            if len(column) < count:
+                column.extend([None] * (count - len(column)))
+            column.append(value)
+        count += 1
+
+    columns: dict[str, list] = {}
+    for name, column in zip(SCALAR_FIELDS, zip(*scalars)):
+        columns[name] = list(column)
+    for name, column in zip(IDENTIFIER_FIELDS, zip(*identifiers)):
+        columns[f"title_ids.{name}"] = list(column)
+    for name, column in dimensions.items():
+        column.extend([None] * (count - len(column)))
+        columns[f"dimension_data.{name}"] = column
+
+    if "item_authors" in columns:
+        columns["item_authors"] = [
+            [dataclasses.asdict(author) for author in authors] if authors else authors
+            for authors in columns["item_authors"]
+        ]
+    return {
+        name: column
+        for name, column in columns.items()
+        if any(value is not None for value in column)
+    }
@@ -0,0 +1,175 @@
+import json
+import logging
+import re
+
+from layout import HEADER_ROWS, sheet_rows
+from models import (
+    Coord,
+    CoordRange,
+    DataFormat,
+    DataHeaders,
+    DataDescriptionData,
+    DateSource,
+    Direction,
+    FileData,
+    Granularity,
+    MetricSource,
+    NonCounterGeneric,
+    ParserDefinitionData,
+    RoleEnum,
+    SheetAttr,
+    TitleIdKind,
+    TitleIdSource,
+    TitleSource,
+    Value,
+)
+from sampling import cell_kind
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MIN_DATE_COLUMNS = 2
+TITLE_ID_HEADERS = {
+    "isbn": TitleIdKind.ISBN,
+    "eisbn": TitleIdKind.ISBN,
+    "issn": TitleIdKind.Print_ISSN,
+    "print issn": TitleIdKind.Print_ISSN,
+    "pissn": TitleIdKind.Print_ISSN,
+    "eissn": TitleIdKind.Online_ISSN,
+    "e issn": TitleIdKind.Online_ISSN,
+    "online issn": TitleIdKind.Online_ISSN,
+    "doi": TitleIdKind.DOI,
+    "uri": TitleIdKind.URI,
+    "url": TitleIdKind.URI,
+    "proprietary": TitleIdKind.Proprietary,
+    "proprietary id": TitleIdKind.Proprietary,
+    "proprietary identifier": TitleIdKind.Proprietary,
+}
+
+
+def normalize_header(value: str) -> str:
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", value.lower()).split())
+
+
+def find_date_header(rows: list[list[str]]) -> tuple[int, int, int] | None:
+    """
+    Find the header row with months across - the first row with a run of at least MIN_DATE_COLUMNS
+    date-like cells, followed by a row with numbers below them.
+    Returns the row, the first column and the number of the date columns.
+    """
+    for r, row in enumerate(rows[:-1]):
+        kinds = [cell_kind(cell) for cell in row]
+        start = next((c for c, kind in enumerate(kinds) if kind == "d"), None)
+        if start is None:
+            continue
+        count = 0
+        while start + count < len(kinds) and kinds[start + count] == "d":
+            count += 1
+        below = rows[r + 1]
+        if count >= MIN_DATE_COLUMNS and len(below) > start and cell_kind(below[start]) == "n":
+            return r, start, count
+    return None
+
+
+def metric_source(sheet_name: str, sheet_names: list[str], metrics: list[str]) -> MetricSource | None:
+    """
+    The single metric of the sheet - the only described metric, or the metric named by the sheet
+    when every sheet is named by a metric.
+    """
+    if len(metrics) == 1:
+        return MetricSource(source=Value(value=metrics[0]), role=RoleEnum.METRIC)
+    lowered = {metric.lower() for metric in metrics}
+    if sheet_name.lower() in lowered and all(name.lower() in lowered for name in sheet_names):
+        return MetricSource(source=SheetAttr(sheet_attr="name"), role=RoleEnum.METRIC)
+    return None
+
+
+def propose_grid(file: FileData, data_description: DataDescriptionData) -> ParserDefinitionData | None:
+    """
+    Propose a definition for a simple grid: titles in the first column, months across the header row
+    and one metric per sheet. Returns None if the file or its description does not look like that.
+    Only the first sheet is inspected, the same as the validation parses only the first sheet.
+    """
+    if not file.sheets or data_description.dimensions:
+        return None
+    if data_description.granularity != Granularity.MONTHLY:
+        return None
+    sheet = file.sheets[0]
+    metrics = metric_source(sheet.name, [s.name for s in file.sheets], data_description.metrics)
+    if metrics is None:
+        return None
+    rows = sheet_rows(sheet.contents, HEADER_ROWS + 1)
+    found = find_date_header(rows)
+    if found is None:
+        return None
+    header_row, date_col, _ = found
+
+    titles = None
+    title_ids = []
+    if data_description.title_report:
+        # titles down the first column, identifiers recognized by their header between the titles and the months
+        if date_col == 0 or cell_kind(rows[header_row + 1][0]) != "t":
+            return None
+        titles = TitleSource(
+            source=CoordRange(coord=Coord(row=header_row + 1, col=0), direction=Direction.DOWN),
+            role=RoleEnum.TITLE,
+        )
+        for col in range(1, date_col):
+            kind = TITLE_ID_HEADERS.get(normalize_header(rows[header_row][col]))
+            if kind is not None and kind in data_description.title_identifiers:
+                title_ids.append(
+                    TitleIdSource(
+                        name=kind,
+                        source=CoordRange(coord=Coord(row=header_row + 1, col=col), direction=Direction.DOWN),
+                        role=RoleEnum.TITLE_ID,
+                    )
+                )
+
+    area = NonCounterGeneric(
+        metrics=metrics,
+        data_headers=DataHeaders(
+            roles=[
+                DateSource(
+                    source=CoordRange(coord=Coord(row=header_row, col=date_col), direction=Direction.RIGHT),
+                    role=RoleEnum.DATE,
+                )
+            ],
+            data_cells=CoordRange(coord=Coord(row=header_row + 1, col=date_col), direction=Direction.RIGHT),
+            data_direction=Direction.DOWN,
+        ),
+        dates=None,
+        titles=titles,
+        title_ids=title_ids,
+        organizations=None,
+    )
+    return ParserDefinitionData(
+        parser_name="heuristic_grid",
+        data_format=DataFormat(),
+        available_metrics=None,
+        areas=[area],
+    )
+
+
+def definition_json(definition: ParserDefinitionData) -> str:
+    """
+    JSON of the definition as accepted by the parsing rules check.
+    Unset optional values are left out, the nibbler definitions do not accept nulls for most of them,
+    only the fields required by ParserDefinitionData are kept as nulls.
+    """
+    data = json.loads(definition.model_dump_json(exclude_none=True))
+    data.setdefault("available_metrics", None)
+    for area in data["areas"]:
+        for name in ("metrics", "dates", "titles", "organizations"):
+            area.setdefault(name, None)
+    return json.dumps(data)
+
+
+def propose_definitions(file: FileData, data_description: DataDescriptionData) -> list[str]:
+    """
+    Definitions proposed by the heuristics for the file, as JSON, most likely first.
+    """
+    proposals = []
+    if (grid := propose_grid(file, data_description)) is not None:
+        proposals.append(definition_json(grid))
+    logger.info(f"Heuristics proposed {len(proposals)} parser definitions")
+    return proposals
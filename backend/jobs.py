@@ -0,0 +1,252 @@
+from pydantic import BaseModel
+from enum import Enum
+from contextvars import ContextVar
+from agents import RunHooks, RunContextWrapper, Agent, Tool
+from agents.items import ModelResponse
+from agents.usage import Usage
+import typing
+import asyncio
+import logging
+import time
+import uuid
+
+from ratelimit import openai_limiter
+from telemetry import mark_llm_start, telemetry
+from profiling import profile_task
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class JobStatus(str, Enum):
+    """
+    Enumeration for the states of a background job.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    @property
+    def finished(self) -> bool:
+        return self in (JobStatus.SUCCEEDED, JobStatus.FAILED, JobStatus.CANCELLED)
+
+
+class JobEvent(BaseModel):
+    """
+    Progress event emitted by a running job (agent turn, tool call, status change...).
+    Seq is the position of the event in the job, used to resume the event stream.
+    """
+    seq: int
+    time: float
+    kind: str
+    data: dict[str, typing.Any] = {}
+
+
+class Job:
+    """
+    Single submitted unit of work (e.g. a FlowWorker run) belonging to a session.
+    The job keeps the list of its progress events and wakes up all stream listeners on each new event.
+    """
+    def __init__(self, session_id: int, name: str) -> None:
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.name = name
+        self.status = JobStatus.QUEUED
+        self.error: str | None = None
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+        self.events: list[JobEvent] = []
+        self.profile_id: str | None = None  # set when profiling is on
+        self.task: asyncio.Task | None = None
+        self._changed = asyncio.Event()
+
+    def emit(self, kind: str, **data: typing.Any) -> None:
+        self.events.append(JobEvent(seq=len(self.events), time=time.time(), kind=kind, data=data))
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def set_status(self, status: JobStatus, error: str | None = None) -> None:
+        self.status = status
+        self.error = error
+        if status == JobStatus.RUNNING:
+            self.started_at = time.time()
+        if status.finished:
+            self.finished_at = time.time()
+        self.emit("status", status=status.value, error=error)
+
+    def info(self) -> dict:
+        return {
+            "job_id": self.id,
+            "session_id": self.session_id,
+            "name": self.name,
+            "status": self.status.value,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "events": len(self.events),
+            "profile_id": self.profile_id,
+        }
+
+    async def stream(self, after: int = 0) -> typing.AsyncIterator[JobEvent]:
+        """
+        Yield the events of the job starting from seq `after`, waiting for new ones until the job finishes.
+        """
+        position = after
+        while True:
+            changed = self._changed
+            while position < len(self.events):
+                yield self.events[position]
+                position += 1
+            if self.status.finished:
+                return
+            await changed.wait()
+
+
+current_job: ContextVar[Job | None] = ContextVar("current_job", default=None)
+
+
+def report_progress(kind: str, **data: typing.Any) -> None:
+    """
+    Report a progress event to the job running in the current context.
+    Does nothing when called outside of a job (e.g. from the synchronous /worker endpoint).
+    """
+    job = current_job.get()
+    if job is not None:
+        job.emit(kind, **data)
+
+
+def usage_summary(usage: Usage) -> dict:
+    """
+    Token counts of the run, with the share of the input tokens served from the provider's prompt cache.
+    """
+    cached = usage.input_tokens_details.cached_tokens or 0
+    return {
+        "requests": usage.requests,
+        "input_tokens": usage.input_tokens,
+        "cached_tokens": cached,
+        "output_tokens": usage.output_tokens,
+        "cached_ratio": round(cached / usage.input_tokens, 3) if usage.input_tokens else None,
+    }
+
+
+class ProgressHooks(RunHooks):
+    """
+    Run hooks forwarding the agent lifecycle (turns, tool calls) as job progress events.
+    The turns report their token usage, the end of the agent the usage of the whole run.
+    Every model request also waits for the shared OpenAI rate limiter.
+    """
+    async def on_agent_start(self, context: RunContextWrapper, agent: Agent) -> None:
+        report_progress("agent_start", agent=agent.name)
+
+    async def on_llm_start(
+        self,
+        context: RunContextWrapper,
+        agent: Agent,
+        system_prompt: str | None,
+        input_items: list,
+    ) -> None:
+        waited = await openai_limiter.acquire()
+        telemetry.inc("ncp_rate_limit_wait_seconds_total", waited, agent=agent.name)
+        if waited > 0.01:
+            report_progress("rate_limited", agent=agent.name, waited=round(waited, 3))
+        mark_llm_start()
+
+    async def on_llm_end(self, context: RunContextWrapper, agent: Agent, response: ModelResponse) -> None:
+        report_progress("agent_turn", agent=agent.name, **usage_summary(response.usage))
+
+    async def on_tool_start(self, context: RunContextWrapper, agent: Agent, tool: Tool) -> None:
+        report_progress("tool_call", agent=agent.name, tool=tool.name)
+
+    async def on_tool_end(self, context: RunContextWrapper, agent: Agent, tool: Tool, result: str) -> None:
+        report_progress("tool_result", agent=agent.name, tool=tool.name)
+
+    async def on_agent_end(self, context: RunContextWrapper, agent: Agent, output: typing.Any) -> None:
+        report_progress("agent_end", agent=agent.name, **usage_summary(context.usage))
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobManager:
+    """
+    Runs submitted jobs in the background.
+    At most `max_queued` jobs may wait for execution, `concurrency` jobs run at once in total
+    and at most `per_session` jobs run at once for a single session.
+    Finished jobs are kept (up to `keep_finished`), so that their status can still be polled.
+    """
+    def __init__(
+        self,
+        max_queued: int = 100,
+        concurrency: int = 4,
+        per_session: int = 1,
+        keep_finished: int = 1000,
+    ) -> None:
+        self.max_queued = max_queued
+        self.per_session = per_session
+        self.keep_finished = keep_finished
+        self.jobs: dict[str, Job] = {}
+        self.slots = asyncio.Semaphore(concurrency)
+        self.session_slots: dict[int, asyncio.Semaphore] = {}
+
+    def queued(self) -> int:
+        return sum(1 for job in self.jobs.values() if job.status == JobStatus.QUEUED)
+
+    def submit(
+        self,
+        session_id: int,
+        name: str,
+        factory: typing.Callable[[], typing.Awaitable[typing.Any]],
+    ) -> Job:
+        """
+        Submit a job, the factory is called to create the awaitable once the job gets its slot.
+        Raises JobQueueFull if too many jobs are already waiting.
+        """
+        if self.queued() >= self.max_queued:
+            raise JobQueueFull(f"Too many queued jobs ({self.max_queued})")
+        job = Job(session_id, name)
+        self.jobs[job.id] = job
+        job.emit("status", status=job.status.value, error=None)
+        job.task = asyncio.create_task(self.execute(job, factory))
+        self.prune()
+        return job
+
+    async def execute(self, job: Job, factory: typing.Callable[[], typing.Awaitable[typing.Any]]) -> None:
+        current_job.set(job)
+        session_slots = self.session_slots.setdefault(
+            job.session_id, asyncio.Semaphore(self.per_session)
+        )
+        try:
+            # acquire the session slot first, so that waiting jobs do not hold the global slots
+            async with session_slots, self.slots:
+                job.set_status(JobStatus.RUNNING)
+                async with profile_task(f"job {job.name}") as job.profile_id:
+                    await factory()
+            job.set_status(JobStatus.SUCCEEDED)
+        except asyncio.CancelledError:
+            job.set_status(JobStatus.CANCELLED)
+        except Exception as e:
+            logger.exception(e)
+            job.set_status(JobStatus.FAILED, str(e))
+        finally:
+            # the slot of the session is dropped with its last job, so that it does not outlive the session
+            if not any(j.session_id == job.session_id and not j.status.finished for j in self.jobs.values()):
+                self.session_slots.pop(job.session_id, None)
+
+    def get(self, job_id: str) -> Job:
+        return self.jobs[job_id]
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.jobs[job_id]
+        if job.task is not None and not job.status.finished:
+            job.task.cancel()
+        return job
+
+    def prune(self) -> None:
+        finished = [job for job in self.jobs.values() if job.status.finished]
+        for job in finished[: max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job.id]
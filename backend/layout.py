@@ -0,0 +1,118 @@
+import csv
+import re
+import hashlib
+import json
+
+from extraction import EMPTY_ROW
+from models import FileData, FileFormat
+from sampling import cell_kind
+
+HEADER_ROWS = 20
+
+
+def sheet_rows(contents: str, limit: int) -> list[list[str]]:
+    """
+    The first rows of the sheet contents as lists of cells, empty rows are empty lists.
+    """
+    lines = contents.split("\n", limit)[:limit]
+    return [[] if line == EMPTY_ROW else next(csv.reader([line]), []) for line in lines if line]
+
+
+# numbers and month names within the text cells, e.g. "Reporting Period: 2024-01-01 to 2024-01-31"
+VARIABLE_PART = re.compile(
+    r"\d+|\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)(?:[a-z]*)\b"
+)
+
+
+def normalize_cell(value: str) -> str:
+    """
+    Text cells are kept (lowercased, whitespace collapsed) with the numbers and month names in them replaced by #,
+    other cells are replaced by their kind, so that e.g. the months in the header or the reporting period
+    in the title do not change the layout from one report to the next.
+    """
+    kind = cell_kind(value)
+    if kind == "t":
+        return VARIABLE_PART.sub("#", " ".join(value.lower().split()))
+    return f"<{kind}>"
+
+
+def cells_shape(row: list[str]) -> str:
+    return "".join(cell_kind(cell) for cell in row)
+
+
+def header_rows(rows: list[list[str]]) -> list[list[str]]:
+    """
+    Rows before the first row containing a number, i.e. the header region of the sheet.
+    """
+    for i, row in enumerate(rows):
+        if any(cell_kind(cell) == "n" for cell in row):
+            return rows[:i]
+    return rows
+
+
+def sheet_layout(name: str | None, contents: str) -> dict:
+    """
+    Structural description of the sheet - its name, normalized header cells and the shape of the first data row.
+    The values of the data rows are left out, so the layout is the same for every report from the same source.
+    """
+    rows = sheet_rows(contents, HEADER_ROWS + 1)
+    header = header_rows(rows)
+    data_shape = cells_shape(rows[len(header)]) if len(header) < len(rows) else ""
+    return {
+        "name": name,
+        "header": [[normalize_cell(cell) for cell in row] for row in header],
+        "data_shape": data_shape,
+    }
+
+
+def file_layout(file: FileData) -> list[dict]:
+    # the only sheet of a CSV file is named by the file, which usually changes with every report
+    return [
+        sheet_layout(None if file.format == FileFormat.CSV else sheet.name, sheet.contents)
+        for sheet in file.sheets
+    ]
+
+
+def layout_fingerprint(file: FileData) -> str:
+    """
+    Fingerprint of the file structure. The described metrics and dimensions are left out,
+    as the model does not name them the same way every time, they are compared by layout_features.
+    """
+    key = {"sheets": file_layout(file)}
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+TOKEN = re.compile(r"[^\W\d_]+")
+
+
+def layout_features(file: FileData, metrics: list[str]) -> set[str]:
+    """
+    Features of the file layout used to find definitions of similar files:
+    the words of the header cells, the positions of the date-like cells in the first rows,
+    the shapes of the first data rows and the described metrics.
+    Unlike the fingerprint, files sharing only a part of these are still comparable (see similarity).
+    """
+    features = {f"metric:{metric.lower()}" for metric in metrics}
+    for i, sheet in enumerate(file.sheets):
+        rows = sheet_rows(sheet.contents, HEADER_ROWS + 1)
+        header = header_rows(rows)
+        for row in header:
+            for cell in row:
+                if cell_kind(cell) == "t":
+                    features.update(f"token:{token}" for token in TOKEN.findall(normalize_cell(cell)))
+        for r, row in enumerate(rows):
+            for c, cell in enumerate(row):
+                if cell_kind(cell) == "d":
+                    features.add(f"date:{i}:{r}:{c}")
+        if len(header) < len(rows):
+            features.add(f"shape:{i}:{cells_shape(rows[len(header)])}")
+    return features
+
+
+def similarity(first: set[str], second: set[str]) -> float:
+    """
+    Jaccard similarity of two feature sets.
+    """
+    if not first and not second:
+        return 0.0
+    return len(first & second) / len(first | second)
@@ -1,18 +1,66 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Request
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request, Header, Body, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, FileResponse, PlainTextResponse
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import logging
 
-from base import Runtime
-from workers import FLOW_WORKERS, BrainClient
-from models import FLOW_DATA, FileData, FileFormat
+from base import Runtime, MissingStateError
+from brain import knowledgebase
+from agent_cache import bypass_cache
+from agent_registry import agent_registry
+from offload import process_pool
+from telemetry import telemetry, current_session
+from profiling import PROFILING, profile_span, request_profiler
+from jobs import JobManager, JobQueueFull
+from batch import Batch, BatchManager, BatchItem
+from sessions import SessionStore, MemorySessionStore, SQLiteSessionStore
+from export import exporter, ExportError, FORMATS
+from storage import store_stream, iter_multipart_file, UploadTooLarge, CHUNK_SIZE, MAX_UPLOAD_SIZE
+from workers import FLOW_WORKERS, GitlabWorker
+from models import FLOW_DATA, FileData, FileFormat, ParsedData, ParserDefinitionData, PlatformData, UserInfoData
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-runtimes: dict[int, Runtime] = {} # Dictionary to store all runtimes
+def create_session_store() -> SessionStore:
+    """
+    Create the session store, sessions are persisted to SQLite when SESSION_DB is set.
+    """
+    limits = {
+        "max_sessions": int(os.environ.get("SESSION_MAX_IN_MEMORY", 100)),
+        "max_idle": float(os.environ.get("SESSION_MAX_IDLE", 3600)),
+        "max_bytes": int(os.environ["SESSION_MAX_BYTES"]) if "SESSION_MAX_BYTES" in os.environ else None,
+    }
+    if db_path := os.environ.get("SESSION_DB"):
+        return SQLiteSessionStore(db_path, FLOW_DATA, **limits)
+    return MemorySessionStore(**limits)
+
+sessions = create_session_store() # Store of all session runtimes
+
+job_manager = JobManager(
+    max_queued=int(os.environ.get("JOBS_MAX_QUEUED", 100)),
+    concurrency=int(os.environ.get("JOBS_CONCURRENCY", 4)),
+    per_session=int(os.environ.get("JOBS_PER_SESSION", 1)),
+)
+
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", 1000)) # Maximum number of parsed rows served at once
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Warm up the Brain knowledgebase cache and keep it refreshed in the background,
+    build the agents shared by all sessions, start the worker processes.
+    """
+    knowledgebase.start()
+    agent_registry.build_all()
+    await process_pool.start()
+    yield
+    await knowledgebase.stop()
+    await process_pool.stop()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware( # Middleware to handle CORS
     CORSMiddleware,
@@ -22,55 +70,133 @@ app.add_middleware( # Middleware to handle CORS
     allow_headers=["*"],
 )
 
-def create_runtime():
-    """
-    Helper function to create a new runtime instance.
-    This function is used to create a new session and store it in the runtimes dictionary.
-    It computes the next session ID by finding the maximum key in the runtimes dictionary and adding 1.
-    """
-    session_id = max(list(runtimes.keys()), default=0) + 1
-    runtimes[session_id] = Runtime()
-    return session_id
+if PROFILING:
+    @app.middleware("http")
+    async def profile_requests(request: Request, call_next):
+        """
+        Profile every request, the spans of the handlers are dumped as a flamegraph-compatible profile.
+        The id of the profile is returned in the X-Profile-Id header.
+        """
+        async with request_profiler.profile(f"{request.method} {request.url.path}") as profile_id:
+            response = await call_next(request)
+        response.headers["X-Profile-Id"] = profile_id
+        return response
 
 @app.post("/start_session")
 def start_session():
     """
     Start a new session and return the session ID.
-    This function creates a new Runtime instance and stores it in the runtimes dictionary.
-    The session ID is the key in the dictionary.
-    The session ID is incremented for each new session.
+    This function creates a new Runtime instance and stores it in the session store,
+    which allocates the session ID.
     """
-    session_id = create_runtime()
+    session_id = sessions.create()
     return {"session_id": session_id}
 
+@app.get("/sessions/stats")
+def get_sessions_stats():
+    """
+    Get the number and size of the sessions held in memory.
+    """
+    return sessions.stats()
+
 
 def get_runtime(session_id: int) -> Runtime:
     """
     Get runtime for given session_id.
     """
     try:
-        return runtimes[session_id]
+        return sessions.get(session_id)
     except KeyError:
         raise HTTPException(status_code=404, detail="Session not found")
 
+async def run_and_save(session_id: int, runtime: Runtime, coro, no_cache: bool = False):
+    """
+    Await the runtime operation and save the session afterwards, even if the operation failed.
+    With no_cache the agents are called even if their responses are cached.
+    """
+    token = bypass_cache.set(no_cache)
+    session_token = current_session.set(session_id)
+    try:
+        return await coro
+    finally:
+        current_session.reset(session_token)
+        bypass_cache.reset(token)
+        sessions.save(session_id, runtime)
+
+def check_upload_size(content_length: int | None):
+    """
+    Reject the upload before reading its body if the declared size is over the limit.
+    """
+    if content_length is not None and content_length > MAX_UPLOAD_SIZE:
+        raise HTTPException(status_code=413, detail=f"File exceeds the size limit of {MAX_UPLOAD_SIZE} bytes")
+
+async def store_upload(session_id: int, runtime: Runtime, chunks, file_name: str) -> dict:
+    """
+    Store the uploaded content and set it as the FileData state of the session.
+    """
+    try:
+        file_format = FileFormat.from_file_extension(file_name)
+        stored = await store_stream(chunks, file_name)
+        runtime.set_state(await FileData.prepared(
+            path=stored.path,
+            format=file_format,
+            file_name=file_name,
+            content_hash=stored.content_hash,
+        ))
+        sessions.save(session_id, runtime)
+        return {
+            "filename": file_name,
+            "content_hash": stored.content_hash,
+            "size": stored.size,
+            "message": "File uploaded successfully",
+        }
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        # unsupported file format or a malformed multipart body
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/upload_file/{session_id}")
-async def upload_file(session_id: int, file: UploadFile = File(...)) -> dict:
+async def upload_file(
+    request: Request,
+    session_id: int,
+    content_length: int | None = Header(default=None),
+) -> dict:
     """
     Upload a file, store it in the server and update current state.
-    The file is stored in the 'uploaded_files' directory.
+    The file is stored content-addressed (by its SHA-256 hash) in the 'uploaded_files' directory,
+    so the same file uploaded by different sessions is stored only once.
     The session ID is used to get the correct runtime instance.
     The file name is used to create a new FileData instance, which is stored in the runtime state.
+    The multipart body (the file in the 'file' field) is parsed as it streams in, so it is never buffered
+    and the size limit applies while the body is read.
     """
+    check_upload_size(content_length)
     runtime = get_runtime(session_id)
+    parts = iter_multipart_file(request.stream(), request.headers.get("content-type", ""))
     try:
-        file_location = f"uploaded_files/{file.filename}"
-        os.makedirs("uploaded_files", exist_ok=True) # create directory if it doesn't exist
-        with open(file_location, "wb") as buffer:
-            buffer.write(await file.read())
-        runtime.set_state(FileData(path=file_location, format=FileFormat.from_file_extension(file.filename)))
-        return {"filename": file.filename, "message": "File uploaded successfully"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        file_name = await parts.__anext__()
+    except (ValueError, StopAsyncIteration) as e:
+        raise HTTPException(status_code=400, detail=str(e) or "No file uploaded")
+    return await store_upload(session_id, runtime, parts, file_name)
+
+@app.put("/upload_file/{session_id}/{file_name}")
+async def upload_file_stream(
+    request: Request,
+    session_id: int,
+    file_name: str,
+    content_length: int | None = Header(default=None),
+) -> dict:
+    """
+    Upload a file sent as the raw request body.
+    Unlike the multipart upload, the body is streamed straight into the storage in chunks,
+    so it is never buffered as a whole.
+    """
+    check_upload_size(content_length)
+    runtime = get_runtime(session_id)
+    return await store_upload(session_id, runtime, request.stream(), file_name)
 
 def get_flow_data(data_name: str):
     """
@@ -98,9 +224,59 @@ async def get_state(session_id: int, data_name: str) -> dict:
     logger.info(f"Getting state for {data_name}")
     runtime = get_runtime(session_id)
     flow_data = get_flow_data(data_name)
-    state = runtime.get_state(data_name, flow_data)
-    logger.info(f"State: {state}")
-    return state.model_dump()
+    try:
+        state = runtime.get_state(flow_data)
+    except MissingStateError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    logger.info(f"State: {state.summary()}")
+    with profile_span("to_response"):
+        return state.to_response()
+
+
+@app.get("/parsed_data/{session_id}")
+async def get_parsed_data(
+    session_id: int,
+    offset: int = Query(default=0, ge=0),
+    limit: int = Query(default=ParsedData.PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    sort_by: str | None = None,
+    descending: bool = False,
+    columns: list[str] | None = Query(default=None),
+):
+    """
+    Get one page of the parsed data, optionally sorted by a column and limited to the given columns.
+    """
+    runtime = get_runtime(session_id)
+    try:
+        parsed_data = runtime.get_state(ParsedData)
+        return parsed_data.page(offset, limit, sort_by, descending, columns)
+    except MissingStateError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/export/{session_id}/parsed_data")
+async def export_parsed_data(session_id: int, format: str = "csv.gz"):
+    """
+    Download the full parsed data in the given format (csv.gz, parquet or feather).
+    The file is written on the first request for the current version of the parsed data,
+    range requests are supported so large downloads can be resumed.
+    """
+    runtime = get_runtime(session_id)
+    try:
+        parsed_data = runtime.get_state(ParsedData)
+        path = await asyncio.to_thread(
+            exporter.export, parsed_data, session_id, runtime.store.version(ParsedData), format
+        )
+    except MissingStateError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    extension, media_type = FORMATS[format]
+    name = "parsed"
+    if FileData in runtime.store and runtime.store.get(FileData).file_name:
+        name = f"{os.path.splitext(runtime.store.get(FileData).file_name)[0]}_parsed"
+    return FileResponse(path, media_type=media_type, filename=f"{name}.{extension}")
 
 
 @app.post("/state/{session_id}/{data_name}")
@@ -112,13 +288,23 @@ async def set_state(request: Request, session_id: int, data_name: str):
     logger.info(f"Setting new state for {data_name}")
     runtime = get_runtime(session_id)
     flow_data = get_flow_data(data_name)
-    data = await request.json()
-    runtime.set_state(flow_data.model_validate(data))
+    with profile_span("request.json"):
+        data = await request.json()
+    if flow_data is FileData and isinstance(data, dict):
+        # the content hash is only set from the stored uploads, never taken from the clients
+        data.pop("content_hash", None)
+        runtime.set_state(await FileData.prepared(**data))
+    else:
+        with profile_span("model_validate"):
+            state = flow_data.model_validate(data)
+        runtime.set_state(state)
+    with profile_span("sessions.save"):
+        sessions.save(session_id, runtime)
     logger.info(f"State set: {data_name}")
 
 
 @app.get("/worker/{session_id}/{worker_name}")
-async def call_worker(session_id: int, worker_name: str):
+async def call_worker(session_id: int, worker_name: str, no_cache: bool = False):
     """
     Execute the specified FlowWorker.
     After execution, inform the user about the success of the operation.
@@ -126,17 +312,260 @@ async def call_worker(session_id: int, worker_name: str):
     logger.info(f"Calling worker {worker_name}")
     runtime = get_runtime(session_id)
     flow_worker = get_flow_worker(worker_name)
-    await runtime.run(flow_worker())
+    try:
+        await run_and_save(session_id, runtime, runtime.run(flow_worker()), no_cache)
+    except MissingStateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     return {"message": f"Worker {worker_name} executed successfully."}
 
+@app.post("/jobs/{session_id}/{worker_name}", status_code=202)
+async def submit_worker_job(session_id: int, worker_name: str, no_cache: bool = False):
+    """
+    Submit the specified FlowWorker as a background job and return the job ID right away.
+    The job status can be polled on /jobs/{job_id} and its progress streamed from /jobs/{job_id}/events.
+    """
+    logger.info(f"Submitting worker {worker_name} job")
+    runtime = get_runtime(session_id)
+    flow_worker = get_flow_worker(worker_name)
+    try:
+        job = job_manager.submit(
+            session_id,
+            worker_name,
+            lambda: run_and_save(session_id, runtime, runtime.run(flow_worker()), no_cache),
+        )
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return job.info()
+
+FILE_FLOW = ["platform_worker", "data_description_worker", "parsing_rules_worker", "translation_worker"]
+GITLAB_FLOW = ["gitlab_worker", *FILE_FLOW]
+
+def default_flow(runtime: Runtime) -> list[str]:
+    """
+    Workers of the full flow of the session, the GitLab worker only runs when a GitLab issue is given.
+    """
+    if UserInfoData in runtime.store and runtime.store.get(UserInfoData).gitlab_issue is not None:
+        return GITLAB_FLOW
+    return FILE_FLOW
+
+@app.post("/flow/{session_id}", status_code=202)
+async def submit_flow_job(
+    session_id: int,
+    workers: list[str] | None = Body(default=None),
+    force: bool = False,
+    no_cache: bool = False,
+):
+    """
+    Submit several FlowWorkers (the full flow of the session by default, see default_flow) as one background job.
+    The workers are scheduled by their input/output dependencies, independent ones run concurrently.
+    Workers whose inputs did not change since their last run are skipped, unless force is set.
+    A flow with missing inputs or cyclic dependencies is rejected with 400 before it is submitted.
+    """
+    runtime = get_runtime(session_id)
+    names = workers or default_flow(runtime)
+    flow = [get_flow_worker(name)() for name in names]
+    try:
+        runtime.check_flow(flow)
+    except (ValueError, MissingStateError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        job = job_manager.submit(
+            session_id,
+            "flow",
+            lambda: run_and_save(session_id, runtime, runtime.run_flow(flow, force=force), no_cache),
+        )
+    except JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return job.info()
+
+def get_job(job_id: str):
+    """
+    Helper function to get job by ID.
+    """
+    try:
+        return job_manager.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """
+    Get the status of the job.
+    """
+    return get_job(job_id).info()
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    Cancel the job if it is still queued or running.
+    """
+    get_job(job_id)
+    return job_manager.cancel(job_id).info()
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, last_event_id: int | None = Header(default=None)):
+    """
+    Stream progress events of the job as Server-Sent Events.
+    The stream ends once the job finishes, the Last-Event-ID header resumes an interrupted stream.
+    """
+    job = get_job(job_id)
+    after = last_event_id + 1 if last_event_id is not None else 0
+
+    async def events():
+        async for event in job.stream(after):
+            yield f"id: {event.seq}\nevent: {event.kind}\ndata: {event.model_dump_json()}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/telemetry/metrics", response_class=PlainTextResponse)
+async def get_telemetry_metrics():
+    """
+    Metrics of the worker runs and agent calls (wall time, time to first token, tokens, cost, tool calls)
+    in the Prometheus text format. /metrics serves the Brain metrics.
+    """
+    return PlainTextResponse(telemetry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/telemetry/sessions/{session_id}")
+async def get_session_trace(session_id: int) -> dict:
+    """
+    Trace of the worker runs and agent calls of the session, with the totals per worker.
+    """
+    return telemetry.trace(session_id)
+
 @app.get("/metrics")
 async def get_brain_metrics():
-    brain_client = BrainClient()
-    metrics = brain_client.get_metrics()
-    return metrics
+    return await knowledgebase.get("metrics")
 
 @app.get("/dimensions")
 async def get_brain_dimensions():
-    brain_client = BrainClient()
-    dimensions = brain_client.get_dimensions()
-    return dimensions
\ No newline at end of file
+    return await knowledgebase.get("dimensions")
+
+
+async def resolve_batch_issue(batch: Batch, item: BatchItem) -> dict:
+    """
+    Resolve the platform of the GitLab issue of the item, store the attachments
+    and add every attachment to the batch as an item of its own.
+    """
+    platform, attachments = await GitlabWorker().resolve_issue(item.gitlab_issue)
+    added = []
+    for attachment, stored in enumerate(attachments):
+        if stored is None:
+            continue
+        added.append(batch.add(BatchItem(
+            source=f"gitlab#{item.gitlab_issue}:{stored.file_name}",
+            file_path=stored.path,
+            file_name=stored.file_name,
+            content_hash=stored.content_hash,
+            gitlab_issue=item.gitlab_issue,
+            gitlab_attachment=attachment,
+            platform_name=platform.platform_name,
+            platform=platform,
+            user_comment=item.user_comment,
+        )).index)
+    if not added:
+        raise ValueError(f"GitLab issue {item.gitlab_issue} has no attachments of a supported format")
+    return {"platform_name": platform.platform_name, "items": added}
+
+async def run_batch_item(batch: Batch, item: BatchItem) -> dict:
+    """
+    Run the full flow for one batch item in a runtime of its own.
+    Every item starts from its stored file and the given platform or the platform resolved from its GitLab issue.
+    Items of GitLab issues resolve the issue instead, see resolve_batch_issue.
+    The runtime is not put into the session store, so that large batches never evict the interactive sessions,
+    the result of the item keeps the platform, the parser definition and the number of parsed records.
+    """
+    if item.file_path is None:
+        return await resolve_batch_issue(batch, item)
+    runtime = Runtime()
+    runtime.set_state(UserInfoData(
+        user_comment=item.user_comment,
+        gitlab_issue=item.gitlab_issue,
+        gitlab_attachment=item.gitlab_attachment,
+    ))
+    runtime.set_state(await FileData.prepared(
+        path=item.file_path,
+        format=FileFormat.from_file_extension(item.file_name),
+        file_name=item.file_name,
+        content_hash=item.content_hash,
+    ))
+    runtime.set_state(item.platform or PlatformData(platform_name=item.platform_name))
+    flow = [get_flow_worker(name)() for name in FILE_FLOW]
+    result = {"workers": await runtime.run_flow(flow)}
+    result["platform_name"] = runtime.store.get(PlatformData).platform_name
+    if ParserDefinitionData in runtime.store:
+        result["parser_definition"] = runtime.store.get(ParserDefinitionData).model_dump(mode="json")
+    if ParsedData in runtime.store:
+        result["records"] = runtime.store.get(ParsedData).row_count
+    return result
+
+batch_manager = BatchManager(run_batch_item, concurrency=int(os.environ.get("BATCH_CONCURRENCY", 4)))
+
+@app.post("/batch", status_code=202)
+async def submit_batch(
+    files: list[UploadFile] = File(default=[]),
+    gitlab_issues: list[int] = Form(default=[]),
+    platform_name: str = Form(default=""),
+    user_comment: str | None = Form(default=None),
+    concurrency: int | None = Form(default=None, ge=1),
+):
+    """
+    Run the full flow for many files at once, each file in a runtime of its own (see run_batch_item).
+    Files are uploaded directly or taken from GitLab issues (every attachment of the issue is one item).
+    Uploaded files need the platform_name. Every GitLab issue is an item of the batch, which fetches the issue,
+    resolves its platform and stores its attachments, then adds them to the batch. A failing issue fails only its item.
+    The items are processed by a pool of `concurrency` workers, the model requests of all of them
+    share the global OpenAI rate limit. Poll /batch/{batch_id} for the per-item results and the throughput.
+    """
+    if files and not platform_name.strip():
+        raise HTTPException(status_code=400, detail="platform_name is required for uploaded files")
+    items = []
+    for file in files:
+        async def chunks():
+            while chunk := await file.read(CHUNK_SIZE):
+                yield chunk
+        if not file.filename:
+            raise HTTPException(status_code=400, detail="Uploaded file has no name")
+        try:
+            FileFormat.from_file_extension(file.filename)
+            stored = await store_stream(chunks(), file.filename)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except UploadTooLarge as e:
+            raise HTTPException(status_code=413, detail=str(e))
+        items.append(BatchItem(
+            source=file.filename,
+            file_path=stored.path,
+            file_name=file.filename,
+            content_hash=stored.content_hash,
+            platform_name=platform_name,
+            user_comment=user_comment,
+        ))
+    for issue in gitlab_issues:
+        items.append(BatchItem(source=f"gitlab#{issue}", gitlab_issue=issue, user_comment=user_comment))
+    if not items:
+        raise HTTPException(status_code=400, detail="No files to process")
+    return batch_manager.submit(items, concurrency).info()
+
+def get_batch(batch_id: str):
+    """
+    Helper function to get batch by ID.
+    """
+    try:
+        return batch_manager.get(batch_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+@app.get("/batch/{batch_id}")
+async def get_batch_status(batch_id: str, items: bool = True):
+    """
+    Get the status and throughput metrics of the batch, with the result or error of every item.
+    """
+    return get_batch(batch_id).info(items)
+
+@app.delete("/batch/{batch_id}")
+async def cancel_batch(batch_id: str):
+    """
+    Cancel the batch, the running items are cancelled and the queued ones are not started.
+    """
+    get_batch(batch_id)
+    return batch_manager.cancel(batch_id).info(items=False)
@@ -1,13 +1,20 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 import typing
 from enum import Enum
 from base import FlowData
 import pandas as pd
 from dataclasses import field
-import openpyxl
+from extraction import extract_sheets, content_key, sheets_cache
+from offload import process_pool
+from profiling import profile_span, profiled
+from sampling import sample_contents, split_budget, estimate_tokens
+import logging
 import os
 from typing import Literal
 
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
 class Coord(BaseModel):
     """
     Used for data localization.
@@ -266,6 +273,7 @@ class UserInfoData(FlowData):
     """
     user_comment: str | None = None
     gitlab_issue: int | None = None
+    gitlab_attachment: int = 0  # index of the issue attachment to process
 
     @staticmethod
     def flow_data_name():
@@ -293,18 +301,33 @@ class Sheet(BaseModel):
     name: str
     contents: str
 
-    def to_llm_format(self) -> str:
-        return f"Sheet name: {self.name}\nSheet Contents (data starts on the next row):\n {self.contents}"
+    def to_llm_format(self, token_budget: int | None = None) -> str:
+        """
+        Format the sheet for the prompt.
+        If the contents do not fit into the token budget, only a sample of the rows is included,
+        each prefixed by its original row index.
+        """
+        sampled = sample_contents(self.contents, token_budget) if token_budget is not None else None
+        if sampled is None:
+            return f"Sheet name: {self.name}\nSheet Contents (data starts on the next row):\n {self.contents}"
+        return (
+            f"Sheet name: {self.name}\n"
+            "Sheet Contents (sampled, each row starts with its zero-based row index in brackets, "
+            "which is not part of the data; omitted rows are marked):\n"
+            f"{sampled}"
+        )
 
 class FileData(FlowData):
     """
     FlowData for storing file information.
     This includes the filename of the file to be processed, including its path.
+    Uploaded files are stored under their content hash, file_name then keeps the original name.
     """
 
     path: str
     format: FileFormat
     file_name: str = ""
+    content_hash: str | None = None
     sheets: list[Sheet] = []
 
     @staticmethod
@@ -312,45 +335,61 @@ class FileData(FlowData):
         return 'file_data'
 
     def model_post_init(self, __context: typing.Any) -> None:
-        self.prepare_file()
-
-    def prepare_file(self) -> None:
-        self.file_name = os.path.basename(self.path)
-        print(f"Preparing file {self.file_name} with format {self.format}")
-        # for csv, read it by rows, fill empty rows, add file name as misc data to the prompt
-        # for excel, for each sheet, read it by rows and create csvs, fill empty rows, add file name and sheet name
-        if self.format == FileFormat.CSV:
-            with open(self.path, 'r') as file:
-                content = file.read()
-                processed_content = ''
-                for line in content.split('\n'):
-                    if not line.strip():
-                        processed_content += "empty-row\n"
-                    else:
-                        processed_content += line + '\n'
-                self.sheets.append(Sheet(name=self.file_name, contents=processed_content))
-
-        if self.format == FileFormat.XLSX:
-            workbook = openpyxl.load_workbook(self.path, read_only=True, data_only=True, keep_links=False)
-            for idx, sheet in enumerate(workbook.worksheets):
-                # For some reason in it necessary to reset dimension for some files
-                # which display that only a single cell is present in the data
-                if sheet.calculate_dimension(force=True) == "A1:A1":
-                    sheet.reset_dimensions()
-
-                sheet_name = sheet.title
-                sheet_csv = ''
-                for row in sheet.rows:
-                    sheet_csv += ','.join([str(cell.value) if cell.value is not None else "" for cell in row]) + '\n'
-                self.sheets.append(Sheet(name=sheet_name, contents=sheet_csv))
-
-        print(f"Sheets: {self.sheets}")
-
-    def to_llm_format(self) -> str:
-        result = ""
-        for sheet in self.sheets:
-            result += sheet.to_llm_format() + '\n\n'
-        return result
+        """
+        Fill in the file name and the sheets already extracted from the file, the file itself is never read here,
+        as the model can be created on the event loop (see prepared).
+        Sheets already present (e.g. in a re-validated dump of prepared FileData) are kept for this data only,
+        they may come from a client, so they are never put into the cache shared by the sessions.
+        """
+        self.file_name = self.file_name or os.path.basename(self.path)
+        if not self.sheets and (cached := sheets_cache.get(self.sheets_key())) is not None:
+            logger.info(f"Using prepared sheets of {self.file_name}")
+            self.sheets = list(cached)
+
+    def sheets_key(self) -> tuple:
+        # the extracted sheets are cached by the file content and format, so preparing the same file again
+        # (re-validation, another session uploading the same file) does not read the file
+        return (content_key(self.path), self.format.value)
+
+    @classmethod
+    @profiled("FileData.prepared")
+    async def prepared(cls, **fields: typing.Any) -> "FileData":
+        """
+        Create the FileData with its sheets, see prepare_file.
+        """
+        data = cls(**fields)
+        await data.prepare_file()
+        return data
+
+    @profiled("FileData.prepare_file")
+    async def prepare_file(self) -> None:
+        """
+        Prepare the text of the sheets, unless they are already present.
+        The sheets are extracted in the process pool, so that reading a large workbook
+        does not block the other sessions, and cached.
+        """
+        if self.sheets:
+            return
+        logger.info(f"Preparing file {self.file_name} with format {self.format} in the process pool")
+        # for csv, read it by rows, mark empty rows, add file name as misc data to the prompt
+        # for excel, for each sheet, read it by rows and create csvs, mark empty rows, add file name and sheet name
+        with profile_span("extract_sheets"):
+            extracted = await process_pool.run(extract_sheets, self.path, self.format, self.file_name)
+        self.sheets = [Sheet(name=name, contents=contents) for name, contents in extracted]
+        size = sum(len(s.contents) for s in self.sheets)
+        sheets_cache.put(self.sheets_key(), list(self.sheets), size)
+        logger.info(f"Prepared {len(self.sheets)} sheets, {size} characters")
+
+    def to_llm_format(self, token_budget: int | None = None) -> str:
+        """
+        Format all sheets for the prompt, optionally fitting them into the token budget.
+        """
+        if token_budget is None:
+            return "".join(sheet.to_llm_format() + '\n\n' for sheet in self.sheets)
+        budgets = split_budget([estimate_tokens(s.contents) for s in self.sheets], token_budget)
+        return "".join(
+            sheet.to_llm_format(budget) + '\n\n' for sheet, budget in zip(self.sheets, budgets)
+        )
     
 class TranslationData(FlowData):
     """
@@ -396,19 +435,91 @@ class DataDescriptionData(FlowData):
 class ParsedData(FlowData):
     """
     FlowData for storing parsed data.
-    This includes the columns and rows of the parsed data.
     The columns are represented as a list of dictionaries,
     where each dictionary contains the field and header for the column.
-    The rows are represented as a list of dictionaries,
-    where each dictionary contains the data for each row.
+    The data is stored column by column (field -> list of values), so the field names
+    are not repeated for every row and the columns can be projected without touching the others.
+    The rows are never sent whole, the page method serves them sorted and paginated,
+    the full dataset is only written by an export.
     The from_df method converts a pandas DataFrame to the FlowData format.
     """
     columns: list[dict[str,str]]
-    rows: list[dict[str,str]]
+    data: dict[str, list] = {}
+    row_count: int = 0
+
+    PAGE_SIZE: typing.ClassVar[int] = 100
+    _orders: dict[tuple[str, bool], list[int]] = PrivateAttr(default_factory=dict)
 
     def from_df(self, df: pd.DataFrame):
-        self.columns = [{"field": col, "header": col} for col in df.columns]
-        self.rows = df.to_dict(orient="records")
+        # missing values become None, so they are serialized as null instead of NaN
+        df = df.astype(object).where(df.notna(), None)
+        self.from_columns(df.to_dict(orient="list"))
+
+    def from_columns(self, columns: dict[str, list]):
+        """
+        Use the columns (field -> values, missing values are None) as they are, without copying them.
+        """
+        self.columns = [{"field": col, "header": col} for col in columns]
+        self.data = columns
+        self.row_count = len(next(iter(columns.values()), []))
+        self._orders = {}
+
+    def to_df(self) -> pd.DataFrame:
+        return pd.DataFrame(self.data, columns=[col["field"] for col in self.columns])
+
+    def order(self, sort_by: str, descending: bool = False) -> list[int]:
+        """
+        Row indices sorted by the column, missing values last.
+        Columns mixing several types are compared as text.
+        The order is cached, so paging through a sorted table sorts it only once.
+        """
+        key = (sort_by, descending)
+        if key not in self._orders:
+            values = pd.Series(self.data[sort_by], dtype=object)
+            try:
+                ordered = values.sort_values(ascending=not descending, na_position="last", kind="stable")
+            except TypeError:
+                ordered = values.map(lambda value: None if value is None else str(value)).sort_values(
+                    ascending=not descending, na_position="last", kind="stable"
+                )
+            self._orders[key] = ordered.index.tolist()
+        return self._orders[key]
+
+    def page(
+        self,
+        offset: int = 0,
+        limit: int | None = None,
+        sort_by: str | None = None,
+        descending: bool = False,
+        fields: list[str] | None = None,
+    ) -> dict:
+        """
+        One page of rows, optionally sorted by a column and projected to the given fields.
+        Raises ValueError for unknown fields.
+        """
+        limit = self.PAGE_SIZE if limit is None else limit
+        fields = fields or [col["field"] for col in self.columns]
+        unknown = [name for name in fields + [sort_by] if name is not None and name not in self.data]
+        if unknown:
+            raise ValueError(f"Unknown columns: {', '.join(unknown)}")
+
+        if sort_by is None:
+            indices = range(offset, min(offset + limit, self.row_count))
+        else:
+            indices = self.order(sort_by, descending)[offset:offset + limit]
+        columns = [self.data[name] for name in fields]
+        return {
+            "columns": [col for name in fields for col in self.columns if col["field"] == name],
+            "rows": [dict(zip(fields, (column[i] for column in columns))) for i in indices],
+            "offset": offset,
+            "limit": limit,
+            "total": self.row_count,
+            "sort_by": sort_by,
+            "descending": descending,
+        }
+
+    def to_response(self) -> dict:
+        return self.page()
 
     @staticmethod
     def flow_data_name():
@@ -0,0 +1,192 @@
+import typing
+import asyncio
+import logging
+import multiprocessing
+import os
+import pickle
+import traceback
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROCESS_WORKERS = int(os.environ.get("PROCESS_WORKERS", os.cpu_count() or 1))
+# fork is not safe in the multithreaded server (a lock held by another thread stays locked in the child)
+START_METHOD = os.environ.get(
+    "PROCESS_START_METHOD", "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+T = typing.TypeVar("T")
+
+
+class ProcessTaskError(Exception):
+    pass
+
+
+def _call(func: typing.Callable, args: tuple, kwargs: dict) -> bytes:
+    try:
+        result = (True, func(*args, **kwargs))
+    except BaseException as e:
+        try:
+            # some exceptions pickle, but cannot be recreated from their args
+            pickle.loads(pickle.dumps(e))
+        except Exception:
+            e = ProcessTaskError(str(e))
+        result = (False, (e, traceback.format_exc()))
+    try:
+        return pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return pickle.dumps((False, (ProcessTaskError(f"Result is not picklable: {e}"), "")))
+
+
+def _serve(connection) -> None:
+    """
+    Main loop of a worker process, runs the calls received from the pipe one by one until it is closed.
+    """
+    while True:
+        try:
+            func, args, kwargs = pickle.loads(connection.recv_bytes())
+        except EOFError:
+            break
+        connection.send_bytes(_call(func, args, kwargs))
+    connection.close()
+
+
+class WorkerProcess:
+    """
+    Long-lived process running the calls sent to it one at a time.
+    Its module-level state (e.g. the caches of validation) survives between the calls,
+    it is lost only when the process is restarted after a crash or a cancelled call.
+    """
+    def __init__(self, context: multiprocessing.context.BaseContext, name: str) -> None:
+        self.context = context
+        self.name = name
+        self.process: multiprocessing.process.BaseProcess | None = None
+        self.connection = None
+        self.transfer: asyncio.Future | None = None  # thread reading or writing the pipe
+        self.pending = 0  # calls running or waiting for the process
+        self._lock: asyncio.Lock | None = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def start(self) -> None:
+        connection, child = self.context.Pipe()
+        self.process = self.context.Process(target=_serve, args=(child,), name=self.name, daemon=True)
+        self.process.start()
+        child.close()
+        self.connection = connection
+        logger.info(f"Started {self.name} (pid {self.process.pid})")
+
+    async def stop(self) -> None:
+        """
+        Terminate the process. The thread still reading or writing the pipe fails once the other end is gone,
+        it is waited for before the pipe is closed.
+        """
+        process, connection, transfer = self.process, self.connection, self.transfer
+        self.process = self.connection = self.transfer = None
+        if process is None:
+            return
+        process.terminate()
+        if transfer is not None:
+            await asyncio.wait([transfer])
+            if not transfer.cancelled():
+                transfer.exception()  # the broken pipe, expected after terminating
+        await asyncio.to_thread(process.join, 5)
+        connection.close()
+
+    async def call(self, func: typing.Callable[..., T], args: tuple, kwargs: dict) -> T:
+        self.pending += 1
+        try:
+            async with self.lock:
+                if self.process is None or not self.process.is_alive():
+                    await self.stop()
+                    # the first start imports the modules of the functions, not done on the event loop
+                    await asyncio.to_thread(self.start)
+                return await self.exchange(func, args, kwargs)
+        finally:
+            self.pending -= 1
+
+    async def transferred(self, method: typing.Callable[..., T], *args: typing.Any) -> T:
+        # large arguments and results are sent in many chunks, each side blocks until the other reads them
+        self.transfer = asyncio.get_running_loop().run_in_executor(None, method, *args)
+        # shielded, so that a cancelled call leaves the future to stop, which waits for the thread
+        result = await asyncio.shield(self.transfer)
+        self.transfer = None
+        return result
+
+    async def exchange(self, func: typing.Callable[..., T], args: tuple, kwargs: dict) -> T:
+        loop = asyncio.get_running_loop()
+        # kept, as a concurrent stop (e.g. of the pool) clears them
+        process, connection = self.process, self.connection
+        payload = pickle.dumps((func, args, kwargs), protocol=pickle.HIGHEST_PROTOCOL)
+        fd = connection.fileno()
+        ready = loop.create_future()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            try:
+                await self.transferred(connection.send_bytes, payload)
+                await ready
+                payload = await self.transferred(connection.recv_bytes)
+            finally:
+                loop.remove_reader(fd)
+        except asyncio.CancelledError:
+            logger.info(f"Terminating {self.name} (pid {process.pid}) running {func.__name__}")
+            await self.stop()
+            raise
+        except (EOFError, OSError):
+            await self.stop()
+            raise ProcessTaskError(f"{self.name} running {func.__name__} exited with code {process.exitcode}")
+        ok, value = pickle.loads(payload)
+        if ok:
+            return value
+        error, trace = value
+        logger.debug(f"{func.__name__} failed in {self.name}:\n{trace}")
+        raise error
+
+
+class ProcessPool:
+    """
+    Runs CPU-bound functions in worker processes, so they neither block the event loop nor hold the GIL.
+    The processes are started once (with a spawn or forkserver context, never forked from the server)
+    and run one call at a time, the arguments and the results are pickled.
+    Calls given a key always go to the same process, so state it caches for the key
+    (e.g. a loaded file) is found by the following calls. Cancelling the awaiting task terminates the process,
+    it is started again by the next call. With workers set to 0, the functions run in a thread instead.
+    """
+    def __init__(self, workers: int = PROCESS_WORKERS, start_method: str = START_METHOD) -> None:
+        context = multiprocessing.get_context(start_method)
+        self.workers = [WorkerProcess(context, f"process-worker-{i}") for i in range(max(0, workers))]
+
+    async def run(self, func: typing.Callable[..., T], *args: typing.Any, **kwargs: typing.Any) -> T:
+        """
+        Run the function in the least busy process.
+        """
+        if not self.workers:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        worker = min(self.workers, key=lambda worker: worker.pending)
+        return await worker.call(func, args, kwargs)
+
+    async def run_keyed(self, key: typing.Hashable, func: typing.Callable[..., T], *args: typing.Any, **kwargs: typing.Any) -> T:
+        """
+        Run the function in the process assigned to the key.
+        """
+        if not self.workers:
+            return await asyncio.to_thread(func, *args, **kwargs)
+        worker = self.workers[hash(key) % len(self.workers)]
+        return await worker.call(func, args, kwargs)
+
+    async def start(self) -> None:
+        for worker in self.workers:
+            async with worker.lock:
+                if worker.process is None:
+                    await asyncio.to_thread(worker.start)
+
+    async def stop(self) -> None:
+        for worker in self.workers:
+            await worker.stop()
+
+
+process_pool = ProcessPool()
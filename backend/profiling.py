@@ -0,0 +1,192 @@
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import typing
+import asyncio
+import contextlib
+import functools
+import inspect
+import json
+import logging
+import os
+import re
+import time
+import tracemalloc
+import uuid
+
+from storage import UPLOAD_DIR
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROFILING = os.environ.get("PROFILING", "").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(UPLOAD_DIR, "profiles"))
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", 1000))  # oldest profiles are removed over the limit
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get("PROFILE_TRACEMALLOC_FRAMES", 1))
+
+F = typing.TypeVar("F", bound=typing.Callable)
+
+
+@dataclass
+class ProfileSpan:
+    name: str
+    parent: "ProfileSpan | None" = None
+    children: list["ProfileSpan"] = field(default_factory=list)
+    start: float = field(default_factory=time.perf_counter)
+    duration: float = 0.0
+    start_memory: int = 0
+    allocated: int = 0  # net change of the traced memory
+    peak: int = 0  # highest traced memory while the span was open
+
+    @property
+    def path(self) -> str:
+        names = []
+        span: ProfileSpan | None = self
+        while span is not None:
+            # the collapsed stack format separates the frames by semicolons
+            names.append(span.name.replace(";", ","))
+            span = span.parent
+        return ";".join(reversed(names))
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "duration": self.duration,
+            "allocated": self.allocated,
+            "peak": self.peak - self.start_memory,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+    def collapsed(self) -> typing.Iterator[str]:
+        """
+        Lines of the collapsed stack format (frames separated by semicolons, then the self time in microseconds),
+        as read by flamegraph.pl or speedscope.
+        """
+        self_time = self.duration - sum(child.duration for child in self.children)
+        yield f"{self.path} {max(0, round(self_time * 1_000_000))}"
+        for child in self.children:
+            yield from child.collapsed()
+
+
+current_profile_span: ContextVar[ProfileSpan | None] = ContextVar("current_profile_span", default=None)
+
+
+def memory() -> tuple[int, int]:
+    return tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+
+
+@contextlib.contextmanager
+def profile_span(name: str) -> typing.Iterator[None]:
+    """
+    Time the block and track its allocations as a span of the profile of the current request.
+    Does nothing when profiling is off or outside of a profiled request.
+    The traced memory is process-wide, so allocations of concurrent requests are attributed to each other.
+    """
+    parent = current_profile_span.get()
+    if not PROFILING or parent is None:
+        yield
+        return
+    current, peak = memory()
+    parent.peak = max(parent.peak, peak)
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    span = ProfileSpan(name=name, parent=parent, start_memory=current, peak=current)
+    parent.children.append(span)
+    token = current_profile_span.set(span)
+    try:
+        yield
+    finally:
+        current_profile_span.reset(token)
+        span.duration = time.perf_counter() - span.start
+        current, peak = memory()
+        span.peak = max(span.peak, peak)
+        span.allocated = current - span.start_memory
+        parent.peak = max(parent.peak, span.peak)
+
+
+def profiled(name: str) -> typing.Callable[[F], F]:
+    """
+    Decorator running the function (sync or async) in a profile span.
+    """
+    def decorator(func: F) -> F:
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with profile_span(name):
+                    return await func(*args, **kwargs)
+            return typing.cast(F, async_wrapper)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_span(name):
+                return func(*args, **kwargs)
+        return typing.cast(F, wrapper)
+    return decorator
+
+
+class RequestProfiler:
+    """
+    Profiles of single requests, each dumped to the profile directory as
+    <id>.folded (wall time in the collapsed stack format) and <id>.json (the span tree with the allocations).
+    """
+    def __init__(self, directory: str = PROFILE_DIR, max_files: int = PROFILE_MAX_FILES) -> None:
+        self.directory = directory
+        self.max_files = max_files
+
+    @contextlib.asynccontextmanager
+    async def profile(self, name: str) -> typing.AsyncIterator[str]:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')[:80]}-{uuid.uuid4().hex[:8]}"
+        current, _ = memory()
+        tracemalloc.reset_peak()
+        root = ProfileSpan(name=name, start_memory=current, peak=current)
+        token = current_profile_span.set(root)
+        try:
+            yield profile_id
+        finally:
+            current_profile_span.reset(token)
+            root.duration = time.perf_counter() - root.start
+            current, peak = memory()
+            root.peak = max(root.peak, peak)
+            root.allocated = current - root.start_memory
+            try:
+                # writing the files and pruning the directory would block the event loop
+                await asyncio.to_thread(self.dump, profile_id, root)
+            except OSError as e:
+                logger.warning(f"Could not write profile {profile_id}: {e}")
+
+    def dump(self, profile_id: str, root: ProfileSpan) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, profile_id)
+        with open(f"{path}.folded", "w") as f:
+            f.write("\n".join(root.collapsed()) + "\n")
+        with open(f"{path}.json", "w") as f:
+            json.dump(root.to_dict(), f, indent=1)
+        logger.info(f"Profile {profile_id}: {root.duration * 1000:.1f} ms, peak {(root.peak - root.start_memory) / 1024:.0f} KiB")
+        self.prune()
+
+    def prune(self) -> None:
+        files = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith((".folded", ".json"))),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in files[: max(0, len(files) - 2 * self.max_files)]:
+            os.remove(entry.path)
+
+
+request_profiler = RequestProfiler()
+
+
+@contextlib.asynccontextmanager
+async def profile_task(name: str) -> typing.AsyncIterator[str | None]:
+    """
+    Profile a background task (e.g. a job) as its own root, yields the id of the profile or None when profiling is off.
+    The task inherits the context of the request submitting it, without a root of its own its spans
+    would be added to the profile of that request, which is dumped before the task runs.
+    """
+    current_profile_span.set(None)
+    if not PROFILING:
+        yield None
+        return
+    async with request_profiler.profile(name) as profile_id:
+        yield profile_id
@@ -1,27 +1,41 @@
+from functools import cache
 from jinja2 import Environment, FileSystemLoader
 
 env = Environment(loader=FileSystemLoader("prompts"))
 parsing_prompt = env.get_template("parsing_rules_prompt.jinja")
+parsing_task_prompt = env.get_template("parsing_rules_task.jinja")
 translation_prompt = env.get_template("translation_prompt.jinja")
 data_description_prompt = env.get_template("data_description_prompt.jinja")
 platform_prompt = env.get_template("platform_prompt.jinja")
 gitlab_prompt = env.get_template("gitlab_issue_prompt.jinja")
 
+@cache  # static prompts are rendered once
 def get_platform_prompt():
     return platform_prompt.render()
 
 
+@cache
 def get_data_description_prompt():
     return data_description_prompt.render()
 
 
+@cache
 def get_translation_prompt():
     return translation_prompt.render()
 
+@cache
 def get_gitlab_prompt():
     return gitlab_prompt.render()
 
-def get_parsing_rules_prompt(
+@cache
+def get_parsing_rules_prompt():
+    """
+    Static part of the parsing rules prompt (the task and the documentation of the parser format).
+    It is the same for every file, so it stays a cacheable prefix of the model requests.
+    """
+    return parsing_prompt.render()
+
+def get_parsing_rules_task(
     metrics: list[str],
     dimensions: list[str],
     month_first: str,
@@ -30,8 +44,12 @@ def get_parsing_rules_prompt(
     title_identifiers: list,
     platform_name: str,
     user_comment: str,
+    examples: list[tuple[float, str]] = [],
 ):
-    prompt = parsing_prompt.render(
+    """
+    Part of the parsing rules prompt describing the file, appended after the static part.
+    """
+    prompt = parsing_task_prompt.render(
         metrics=metrics,
         dimensions=dimensions,
         month_first=month_first,
@@ -40,5 +58,6 @@ def get_parsing_rules_prompt(
         title_identifiers=title_identifiers,
         platform_name=platform_name,
         user_comment=user_comment,
+        examples=examples,
     )
     return prompt
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import os
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Token bucket limiting the rate of requests shared by all tasks of the process.
+    Up to `burst` requests may start at once, after that they are spread evenly at `rate_per_minute`.
+    """
+    def __init__(self, rate_per_minute: float, burst: int | None = None) -> None:
+        self.rate = rate_per_minute / 60
+        self.capacity = burst if burst is not None else max(1, int(self.rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> float:
+        """
+        Wait until a request may start, returns the number of seconds waited.
+        """
+        start = time.monotonic()
+        # the lock makes the waiting requests start in order
+        async with self.lock:
+            self.refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= 1
+        return time.monotonic() - start
+
+
+# shared by all agent runs, so that parallel sessions and batches together stay under the OpenAI limits
+openai_limiter = RateLimiter(
+    rate_per_minute=float(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", 500)),
+    burst=int(os.environ["OPENAI_REQUESTS_BURST"]) if "OPENAI_REQUESTS_BURST" in os.environ else None,
+)
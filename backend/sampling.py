@@ -0,0 +1,123 @@
+import typing
+import csv
+import os
+import re
+
+from extraction import EMPTY_ROW
+
+CHARS_PER_TOKEN = 4  # rough estimate for the OpenAI tokenizers on tabular text
+DEFAULT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", 30000))
+OMITTED_MARKER_TOKENS = 8
+
+NUMBER = re.compile(r"^[-+]?[\d\s.,]*\d%?$")
+DATE_LIKE = re.compile(
+    r"^(\d{4}-\d{1,2}(-\d{1,2})?.*|\d{1,2}[./-]\d{1,2}[./-]\d{2,4}|\d{1,2}[-/]\d{2,4}|"
+    r"(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*[\s\-/.']*(\d{2,4})?)$",
+    re.IGNORECASE,
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def cell_kind(value: str) -> str:
+    value = value.strip()
+    if not value:
+        return "e"
+    if DATE_LIKE.match(value):
+        return "d"
+    if NUMBER.match(value):
+        return "n"
+    return "t"
+
+
+def row_shape(line: str) -> str:
+    """
+    Shape of the row - the kinds of its cells (empty, number, date-like, text), e.g. "tdnnn".
+    Rows of the same shape are usually rows of the same table, so one of them represents the others.
+    """
+    if line == EMPTY_ROW:
+        return ""
+    cells = next(csv.reader([line]), [])
+    return "".join(cell_kind(cell) for cell in cells)
+
+
+def select_rows(
+    lines: list[str],
+    budget: int,
+    head_rows: int = 20,
+    tail_rows: int = 5,
+) -> list[int]:
+    """
+    Select the indices of rows fitting into the token budget, in this priority:
+    the header region (first head_rows rows), the last tail_rows rows, one row of each distinct
+    row shape and finally rows spread evenly over the rest of the sheet.
+    The first row is always selected.
+    """
+    count = len(lines)
+    candidates = list(range(min(head_rows, count)))
+    candidates += range(max(head_rows, count - tail_rows), count)
+    shapes = set()
+    for i, line in enumerate(lines):
+        shape = row_shape(line)
+        if shape not in shapes:
+            shapes.add(shape)
+            candidates.append(i)
+    step = max(1, count // 200)
+    candidates += range(0, count, step)
+
+    def cost(i: int) -> int:
+        # the row with its index prefix and a possible marker of the omitted rows before it
+        return estimate_tokens(f"[row {i}] {lines[i]}") + OMITTED_MARKER_TOKENS
+
+    selected: set[int] = {0}
+    used = cost(0) if lines else 0
+    for i in candidates:
+        if i in selected:
+            continue
+        if used + cost(i) > budget:
+            continue
+        selected.add(i)
+        used += cost(i)
+    return sorted(selected)
+
+
+def sample_contents(contents: str, budget: int) -> str | None:
+    """
+    Sample the sheet contents (one row per line) to fit into the token budget.
+    Returns None if the contents fit as they are. Otherwise every kept row is prefixed
+    by its original zero-based row index, so the coordinates still point at the real cells,
+    and the omitted regions are marked.
+    """
+    if estimate_tokens(contents) <= budget:
+        return None
+    lines = contents.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    result = []
+    previous = -1
+    for i in select_rows(lines, budget):
+        if i > previous + 1:
+            result.append(f"... rows {previous + 1}-{i - 1} omitted ...")
+        result.append(f"[row {i}] {lines[i]}")
+        previous = i
+    if previous < len(lines) - 1:
+        result.append(f"... rows {previous + 1}-{len(lines) - 1} omitted ...")
+    return "\n".join(result) + "\n"
+
+
+def split_budget(sizes: typing.Sequence[int], budget: int) -> list[int]:
+    """
+    Split the token budget between sheets of the given sizes.
+    Sheets smaller than their fair share keep their full size and the rest is shared by the larger ones.
+    """
+    shares = [0] * len(sizes)
+    remaining = budget
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    while pending:
+        fair = remaining // len(pending)
+        i = pending.pop(0)
+        shares[i] = min(sizes[i], fair)
+        remaining -= shares[i]
+    return shares
@@ -0,0 +1,251 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from base import Runtime, FlowData
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedSession:
+    """
+    Runtime held in memory together with its bookkeeping.
+    Sizes are the serialized sizes of the state entries, keyed by data name and recorded per version.
+    """
+    runtime: Runtime
+    last_used: float = field(default_factory=time.monotonic)
+    revision: int = 0
+    sizes: dict[str, tuple[int, int]] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        return sum(size for _, size in self.sizes.values())
+
+
+class SessionStore(ABC):
+    """
+    Base abstract class for storing session runtimes.
+    Sessions are kept in memory in LRU order, sessions exceeding `max_sessions`, `max_bytes`
+    or idle for more than `max_idle` seconds are evicted from memory.
+    Subclasses decide what eviction means - dropping the session or paging it out to persistent storage.
+    """
+    def __init__(
+        self,
+        max_sessions: int | None = None,
+        max_idle: float | None = None,
+        max_bytes: int | None = None,
+    ) -> None:
+        self.max_sessions = max_sessions
+        self.max_idle = max_idle
+        self.max_bytes = max_bytes
+        self.cache: OrderedDict[int, CachedSession] = OrderedDict()
+        self.lock = threading.RLock()
+
+    @abstractmethod
+    def create(self) -> int:
+        """Create a new session and return its ID."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load(self, session_id: int, cached: CachedSession | None) -> CachedSession:
+        """
+        Get the session, reusing the cached one if it is still current.
+        Raises KeyError if the session does not exist.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def persist(self, session_id: int, cached: CachedSession, changed: list[FlowData]) -> None:
+        """Store the changed state entries of the session."""
+        raise NotImplementedError
+
+    def get(self, session_id: int) -> Runtime:
+        with self.lock:
+            cached = self.load(session_id, self.cache.get(session_id))
+            cached.last_used = time.monotonic()
+            self.cache[session_id] = cached
+            self.cache.move_to_end(session_id)
+            self.evict()
+            return cached.runtime
+
+    def save(self, session_id: int, runtime: Runtime) -> None:
+        """
+        Save the session after its runtime was modified.
+        Only the entries whose version changed since the last save are processed.
+        """
+        with self.lock:
+            cached = self.cache.get(session_id)
+            if cached is None or cached.runtime is not runtime:
+                cached = CachedSession(runtime=runtime, revision=cached.revision if cached else 0)
+            changed = []
+            for t, entry in runtime.store.entries.items():
+                name = t.flow_data_name()
+                saved = cached.sizes.get(name)
+                if saved is None or saved[0] != entry.version:
+                    changed.append(entry.data)
+                    cached.sizes[name] = (entry.version, 0)
+            self.persist(session_id, cached, changed)
+            cached.last_used = time.monotonic()
+            self.cache[session_id] = cached
+            self.cache.move_to_end(session_id)
+            self.evict()
+
+    def evict(self) -> None:
+        now = time.monotonic()
+        total = sum(cached.size for cached in self.cache.values())
+        # the most recently used session is never evicted
+        while len(self.cache) > 1:
+            session_id, oldest = next(iter(self.cache.items()))
+            if not (
+                (self.max_sessions is not None and len(self.cache) > self.max_sessions)
+                or (self.max_bytes is not None and total > self.max_bytes)
+                or (self.max_idle is not None and now - oldest.last_used > self.max_idle)
+            ):
+                break
+            del self.cache[session_id]
+            total -= oldest.size
+            self.on_evict(session_id, oldest)
+
+    def on_evict(self, session_id: int, cached: CachedSession) -> None:
+        logger.info(f"Session {session_id} evicted from memory ({cached.size} bytes)")
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "sessions_in_memory": len(self.cache),
+                "bytes_in_memory": sum(cached.size for cached in self.cache.values()),
+            }
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Session store keeping the sessions only in memory, evicted sessions are lost.
+    Memory accounting (serializing the changed entries) is done only when `max_bytes` is set.
+    """
+    def __init__(self, **limits) -> None:
+        super().__init__(**limits)
+        self.next_id = 1
+
+    def create(self) -> int:
+        with self.lock:
+            session_id = self.next_id
+            self.next_id += 1
+            self.cache[session_id] = CachedSession(runtime=Runtime())
+            self.evict()
+            return session_id
+
+    def load(self, session_id: int, cached: CachedSession | None) -> CachedSession:
+        if cached is None:
+            raise KeyError(session_id)
+        return cached
+
+    def persist(self, session_id: int, cached: CachedSession, changed: list[FlowData]) -> None:
+        if self.max_bytes is None:
+            return
+        for data in changed:
+            name = data.flow_data_name()
+            cached.sizes[name] = (cached.sizes[name][0], len(data.model_dump_json()))
+
+    def on_evict(self, session_id: int, cached: CachedSession) -> None:
+        logger.info(f"Session {session_id} expired ({cached.size} bytes)")
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Session store persisting the sessions to a SQLite database.
+    Several worker processes can share the database, each session has a revision
+    which is incremented on every save, so a process reloads a session modified by another process.
+    Evicted sessions are only dropped from memory and loaded back from the database when needed.
+    """
+    def __init__(self, path: str, data_types: set[type[FlowData]], **limits) -> None:
+        super().__init__(**limits)
+        self.data_types = {t.flow_data_name(): t for t in data_types}
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                revision INTEGER NOT NULL DEFAULT 0,
+                worker_inputs TEXT NOT NULL DEFAULT '{}',
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS session_state (
+                session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+                name TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (session_id, name)
+            );
+            """
+        )
+
+    def create(self) -> int:
+        with self.lock:
+            now = time.time()
+            cursor = self.connection.execute(
+                "INSERT INTO sessions (created_at, updated_at) VALUES (?, ?)", (now, now)
+            )
+            session_id = cursor.lastrowid
+            self.cache[session_id] = CachedSession(runtime=Runtime())
+            self.evict()
+            return session_id
+
+    def load(self, session_id: int, cached: CachedSession | None) -> CachedSession:
+        row = self.connection.execute(
+            "SELECT revision, worker_inputs FROM sessions WHERE id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(session_id)
+        revision, worker_inputs = row
+        if cached is not None and cached.revision == revision:
+            return cached
+
+        logger.info(f"Loading session {session_id} revision {revision}")
+        cached = CachedSession(runtime=Runtime(), revision=revision)
+        cached.runtime.worker_inputs = {
+            name: tuple(versions) for name, versions in json.loads(worker_inputs).items()
+        }
+        for name, version, data in self.connection.execute(
+            "SELECT name, version, data FROM session_state WHERE session_id = ?", (session_id,)
+        ):
+            t = self.data_types.get(name)
+            if t is None:
+                continue
+            cached.runtime.store.load(t.model_validate_json(data), version)
+            cached.sizes[name] = (version, len(data))
+        return cached
+
+    def persist(self, session_id: int, cached: CachedSession, changed: list[FlowData]) -> None:
+        rows = []
+        for data in changed:
+            name = data.flow_data_name()
+            serialized = data.model_dump_json()
+            version = cached.sizes[name][0]
+            cached.sizes[name] = (version, len(serialized))
+            rows.append((session_id, name, version, serialized))
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO session_state (session_id, name, version, data) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self.connection.execute(
+                "UPDATE sessions SET revision = revision + 1, worker_inputs = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(cached.runtime.worker_inputs), time.time(), session_id),
+            )
+            (cached.revision,) = self.connection.execute(
+                "SELECT revision FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+
+    def on_evict(self, session_id: int, cached: CachedSession) -> None:
+        logger.info(f"Session {session_id} paged out of memory ({cached.size} bytes)")
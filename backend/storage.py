@@ -0,0 +1,166 @@
+from dataclasses import dataclass
+import typing
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+
+from python_multipart.multipart import MultipartParser, parse_options_header
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = "uploaded_files"
+OBJECTS_DIR = os.path.join(UPLOAD_DIR, "objects")
+CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", 100 * 1024 * 1024))
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+@dataclass
+class StoredFile:
+    """
+    Uploaded file stored in the content-addressed storage.
+    The path is derived from the SHA-256 hash of the content, the original file name is kept separately.
+    """
+    path: str
+    file_name: str
+    content_hash: str
+    size: int
+    deduplicated: bool
+
+
+async def store_stream(
+    chunks: typing.AsyncIterator[bytes],
+    file_name: str,
+    max_size: int = MAX_UPLOAD_SIZE,
+) -> StoredFile:
+    """
+    Write the streamed content into the content-addressed storage, hashing it on the way.
+    The content is never held in memory as a whole. If the same content is already stored,
+    the new copy is dropped and the existing file is reused.
+    Raises UploadTooLarge as soon as the content exceeds max_size.
+    """
+    os.makedirs(OBJECTS_DIR, exist_ok=True)
+    # keep the extension, the readers pick the file format by it
+    suffix = os.path.splitext(file_name)[1].lower()
+    fd, tmp_path = tempfile.mkstemp(dir=OBJECTS_DIR, suffix=".part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge(f"File exceeds the size limit of {max_size} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+        content_hash = digest.hexdigest()
+        path = os.path.join(OBJECTS_DIR, f"{content_hash}{suffix}")
+        deduplicated = os.path.exists(path)
+        if deduplicated:
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    logger.info(
+        f"Stored {file_name} as {path} ({size} bytes{', deduplicated' if deduplicated else ''})"
+    )
+    return StoredFile(
+        path=path,
+        file_name=file_name,
+        content_hash=content_hash,
+        size=size,
+        deduplicated=deduplicated,
+    )
+
+
+async def store_file(path: str, file_name: str, max_size: int = MAX_UPLOAD_SIZE) -> StoredFile:
+    """
+    Copy a local file (e.g. a downloaded attachment) into the content-addressed storage.
+    """
+    async def chunks():
+        with open(path, "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, CHUNK_SIZE):
+                yield chunk
+
+    return await store_stream(chunks(), file_name, max_size)
+
+
+async def iter_multipart_file(
+    chunks: typing.AsyncIterator[bytes],
+    content_type: str,
+    field: str = "file",
+) -> typing.AsyncIterator[str | bytes]:
+    """
+    Stream the file of the given field out of a multipart/form-data body, the body is never buffered.
+    The first item is the file name, the chunks of the content follow.
+    Raises ValueError if the body is not multipart or there is no named file in the field.
+    """
+    mime, options = parse_options_header(content_type)
+    if mime != b"multipart/form-data" or b"boundary" not in options:
+        raise ValueError("Expected a multipart/form-data body")
+    events: list[tuple[str, bytes]] = []
+    headers: dict[bytes, bytes] = {}
+    header_field = bytearray()
+    header_value = bytearray()
+
+    def on_header_field(data: bytes, start: int, end: int) -> None:
+        header_field.extend(data[start:end])
+
+    def on_header_value(data: bytes, start: int, end: int) -> None:
+        header_value.extend(data[start:end])
+
+    def on_header_end() -> None:
+        headers[bytes(header_field).lower()] = bytes(header_value)
+        header_field.clear()
+        header_value.clear()
+
+    def on_headers_finished() -> None:
+        events.append(("part", headers.pop(b"content-disposition", b"")))
+        headers.clear()
+
+    def on_part_data(data: bytes, start: int, end: int) -> None:
+        events.append(("data", data[start:end]))
+
+    def on_part_end() -> None:
+        events.append(("end", b""))
+
+    # the parser is fed chunk by chunk, the callbacks collect the events of the chunk
+    parser = MultipartParser(options[b"boundary"], callbacks={
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    found = in_file = False
+    async for chunk in chunks:
+        parser.write(chunk)
+        for kind, value in events:
+            if kind == "part":
+                _, disposition = parse_options_header(value)
+                file_name = disposition.get(b"filename", b"").decode("utf-8", "replace")
+                # some browsers send the full client path
+                file_name = os.path.basename(file_name.replace("\\", "/"))
+                in_file = not found and disposition.get(b"name") == field.encode() and bool(file_name)
+                if in_file:
+                    found = True
+                    yield file_name
+            elif kind == "data" and in_file:
+                yield value
+            elif kind == "end":
+                in_file = False
+        events.clear()
+    parser.finalize()
+    if not found:
+        raise ValueError(f"No file with a name in the form field '{field}'")
@@ -0,0 +1,328 @@
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+import typing
+import asyncio
+import contextlib
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+from agents import Agent, Runner
+from agents.result import RunResultBase
+from agents.usage import Usage
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+TELEMETRY_MAX_SESSIONS = int(os.environ.get("TELEMETRY_MAX_SESSIONS", 1000))  # sessions with a kept trace
+TELEMETRY_MAX_SPANS = int(os.environ.get("TELEMETRY_MAX_SPANS", 500))  # spans kept per session
+# USD per million input, cached input and output tokens
+MODEL_PRICES: dict[str, tuple[float, float, float]] = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-5.1": (1.25, 0.125, 10.00),
+    **{
+        model: tuple(prices)
+        for model, prices in json.loads(os.environ.get("TELEMETRY_MODEL_PRICES", "{}")).items()
+    },
+}
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# name: (type, help)
+METRICS = {
+    "ncp_worker_runs_total": ("counter", "Finished runs of the flow workers."),
+    "ncp_worker_duration_seconds": ("histogram", "Wall time of the flow worker runs."),
+    "ncp_agent_calls_total": ("counter", "Agent calls, including the ones served from the agent cache."),
+    "ncp_agent_duration_seconds": ("histogram", "Wall time of the agent calls."),
+    "ncp_agent_ttft_seconds": ("histogram", "Time to the first streamed token of the model requests."),
+    "ncp_agent_requests_total": ("counter", "Model requests made by the agents."),
+    "ncp_agent_tokens_total": ("counter", "Tokens of the model requests by kind (input, cached, output)."),
+    "ncp_agent_cost_usd_total": ("counter", "Estimated cost of the model requests by MODEL_PRICES."),
+    "ncp_agent_tool_calls_total": ("counter", "Tool calls made by the agents."),
+    "ncp_rate_limit_wait_seconds_total": ("counter", "Time the model requests waited for the OpenAI rate limit."),
+}
+
+current_session: ContextVar[int | None] = ContextVar("current_session", default=None)
+current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+
+
+def model_name(agent: Agent) -> str:
+    if isinstance(agent.model, str):
+        return agent.model
+    return getattr(agent.model, "model", None) or "default"
+
+
+def token_cost(model: str, usage: Usage) -> float | None:
+    """
+    Estimated cost of the tokens in USD, None for models without a price.
+    """
+    if (prices := MODEL_PRICES.get(model)) is None:
+        return None
+    input_price, cached_price, output_price = prices
+    cached = usage.input_tokens_details.cached_tokens or 0
+    return (
+        (usage.input_tokens - cached) * input_price + cached * cached_price + usage.output_tokens * output_price
+    ) / 1_000_000
+
+
+@dataclass
+class Span:
+    """
+    Timing of a worker run or an agent call, the agent calls are children of the worker running them.
+    """
+    id: int
+    kind: str
+    name: str
+    session_id: int | None
+    parent: "Span | None"
+    started_at: float = field(default_factory=time.time)
+    start: float = field(default_factory=time.perf_counter)
+    duration: float | None = None
+    status: str = "running"
+    attributes: dict[str, typing.Any] = field(default_factory=dict)
+    request_start: float | None = None  # of the model request waiting for its first token
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "parent_id": self.parent.id if self.parent else None,
+            "kind": self.kind,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": self.duration,
+            "status": self.status,
+            **self.attributes,
+        }
+
+
+def labels_text(labels: tuple) -> str:
+    def escape(value: typing.Any) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}" if labels else ""
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = DURATION_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Telemetry:
+    """
+    Metrics of the worker runs and agent calls, and the traces of their spans per session.
+    The metrics are rendered in the Prometheus text format, the traces keep the last max_spans spans
+    of the last max_sessions sessions.
+    """
+    def __init__(self, max_sessions: int = TELEMETRY_MAX_SESSIONS, max_spans: int = TELEMETRY_MAX_SPANS) -> None:
+        self.max_sessions = max_sessions
+        self.max_spans = max_spans
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.traces: OrderedDict[int, deque[dict]] = OrderedDict()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def inc(self, metric: str, value: float = 1, **labels: str) -> None:
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, metric: str, value: float, **labels: str) -> None:
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            self.histograms.setdefault(key, Histogram()).observe(value)
+
+    @contextlib.contextmanager
+    def span(self, kind: str, name: str, **attributes: typing.Any) -> typing.Iterator[Span]:
+        span = Span(
+            id=next(self.ids),
+            kind=kind,
+            name=name,
+            session_id=current_session.get(),
+            parent=current_span.get(),
+            attributes=attributes,
+        )
+        token = current_span.set(span)
+        try:
+            yield span
+            span.status = "ok"
+        except asyncio.CancelledError:
+            span.status = "cancelled"
+            raise
+        except Exception as e:
+            span.status = "error"
+            span.attributes["error"] = str(e)
+            raise
+        finally:
+            current_span.reset(token)
+            span.duration = time.perf_counter() - span.start
+            self.finish(span)
+
+    def finish(self, span: Span) -> None:
+        if span.kind == "worker":
+            self.inc("ncp_worker_runs_total", worker=span.name, status=span.status)
+            self.observe("ncp_worker_duration_seconds", span.duration, worker=span.name)
+        elif span.kind == "agent":
+            self.finish_agent(span)
+        if span.session_id is not None:
+            with self.lock:
+                trace = self.traces.pop(span.session_id, None) or deque(maxlen=self.max_spans)
+                trace.append(span.to_dict())
+                self.traces[span.session_id] = trace
+                while len(self.traces) > self.max_sessions:
+                    self.traces.popitem(last=False)
+
+    def finish_agent(self, span: Span) -> None:
+        attributes = span.attributes
+        labels = {"agent": span.name, "model": attributes["model"]}
+        self.inc("ncp_agent_calls_total", **labels, status=span.status, cache_hit=str(attributes["cache_hit"]).lower())
+        if attributes["cache_hit"]:
+            return
+        self.observe("ncp_agent_duration_seconds", span.duration, **labels)
+        for ttft in attributes.get("ttft", []):
+            self.observe("ncp_agent_ttft_seconds", ttft, **labels)
+        self.inc("ncp_agent_requests_total", attributes.get("requests", 0), **labels)
+        for kind in ("input", "cached", "output"):
+            self.inc("ncp_agent_tokens_total", attributes.get(f"{kind}_tokens", 0), **labels, kind=kind)
+        if attributes.get("cost") is not None:
+            self.inc("ncp_agent_cost_usd_total", attributes["cost"], **labels)
+        for tool, count in attributes.get("tool_calls", {}).items():
+            self.inc("ncp_agent_tool_calls_total", count, agent=span.name, tool=tool)
+
+    @staticmethod
+    def add(key: str, value: float = 1) -> None:
+        """
+        Add to a counting attribute of the innermost worker span (e.g. the check_parsing_rules iterations).
+        """
+        span = current_span.get()
+        while span is not None and span.kind != "worker":
+            span = span.parent
+        if span is not None:
+            span.attributes[key] = span.attributes.get(key, 0) + value
+
+    def trace(self, session_id: int) -> dict:
+        """
+        Spans of the session in the order they finished, with the totals per worker.
+        """
+        with self.lock:
+            spans = list(self.traces.get(session_id, ()))
+        workers: dict[str, dict] = {}
+        for span in spans:
+            worker = span["name"] if span["kind"] == "worker" else span.get("worker")
+            if worker is None:
+                continue
+            totals = workers.setdefault(worker, {
+                "runs": 0, "duration": 0.0, "agent_calls": 0,
+                "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "cost": 0.0,
+            })
+            if span["kind"] == "worker":
+                totals["runs"] += 1
+                totals["duration"] += span["duration"]
+            else:
+                totals["agent_calls"] += 1
+                for key in ("input_tokens", "cached_tokens", "output_tokens"):
+                    totals[key] += span.get(key, 0)
+                totals["cost"] += span.get("cost") or 0.0
+        return {"session_id": session_id, "workers": workers, "spans": spans}
+
+    def render(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for metric, (kind, help) in METRICS.items():
+                lines += [f"# HELP {metric} {help}", f"# TYPE {metric} {kind}"]
+                if kind == "counter":
+                    for (name, labels), value in sorted(self.counters.items()):
+                        if name == metric:
+                            lines.append(f"{metric}{labels_text(labels)} {value}")
+                    continue
+                for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if name != metric:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{metric}_bucket{labels_text(labels + (('le', bound),))} {count}")
+                    lines.append(f"{metric}_bucket{labels_text(labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{metric}_sum{labels_text(labels)} {histogram.sum}")
+                    lines.append(f"{metric}_count{labels_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+telemetry = Telemetry()
+
+
+def mark_llm_start() -> None:
+    """
+    Called right before a model request, the time to its first token is measured from here.
+    """
+    span = current_span.get()
+    if span is not None and span.kind == "agent":
+        span.request_start = time.perf_counter()
+
+
+def agent_span(agent: Agent, cache_hit: bool = False) -> typing.ContextManager[Span]:
+    parent = current_span.get()
+    return telemetry.span(
+        "agent",
+        agent.name,
+        model=model_name(agent),
+        cache_hit=cache_hit,
+        worker=parent.name if parent is not None and parent.kind == "worker" else None,
+    )
+
+
+async def run_agent(agent: Agent, input: str, **kwargs: typing.Any) -> RunResultBase:
+    """
+    Runner.run recording the agent call in the telemetry.
+    The run is streamed to measure the time to the first token of every model request and to count the tool calls,
+    the tokens are taken from the usage of the finished run.
+    """
+    with agent_span(agent) as span:
+        ttft: list[float] = []
+        tool_calls: dict[str, int] = {}
+        span.attributes.update(ttft=ttft, tool_calls=tool_calls)
+        result = Runner.run_streamed(agent, input, **kwargs)
+
+        async def consume():
+            async for event in result.stream_events():
+                if event.type == "raw_response_event":
+                    if span.request_start is not None and event.data.type.endswith(".delta"):
+                        ttft.append(time.perf_counter() - span.request_start)
+                        span.request_start = None
+                elif event.type == "run_item_stream_event" and event.name == "tool_called":
+                    tool = getattr(event.item.raw_item, "name", None) or "unknown"
+                    tool_calls[tool] = tool_calls.get(tool, 0) + 1
+
+        consumer = asyncio.ensure_future(consume())
+        try:
+            # stream_events swallows the cancellation, so the consumer is shielded and the run cancelled here
+            await asyncio.shield(consumer)
+        except asyncio.CancelledError:
+            result.cancel()
+            consumer.cancel()
+            raise
+        finally:
+            usage = result.context_wrapper.usage
+            span.attributes.update(
+                requests=usage.requests,
+                input_tokens=usage.input_tokens,
+                cached_tokens=usage.input_tokens_details.cached_tokens or 0,
+                output_tokens=usage.output_tokens,
+                cost=token_cost(span.attributes["model"], usage),
+            )
+    return result
@@ -0,0 +1,126 @@
+from collections import Counter
+import typing
+import logging
+import os
+import re
+import unicodedata
+
+from brain import BrainDimension, BrainMetric, knowledgebase
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FUZZY_THRESHOLD = float(os.environ.get("TRANSLATION_FUZZY_THRESHOLD", 0.7))
+NON_ALNUM = re.compile(r"[\W_]+")
+
+
+def normalize(term: str) -> str:
+    """
+    Lowercase the term, strip the accents and replace punctuation by single spaces,
+    e.g. "Page-Views " and "page views" are the same term.
+    """
+    decomposed = unicodedata.normalize("NFKD", term)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(NON_ALNUM.sub(" ", stripped.casefold()).split())
+
+
+def trigrams(text: str) -> list[str]:
+    padded = f"  {text} "
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+class AliasIndex:
+    """
+    Index of the Brain metric or dimension names and their aliases, resolving terms to the short names.
+    Terms are matched exactly, then normalized (see normalize) and finally fuzzily by the Dice
+    coefficient of their character trigrams, using an inverted trigram index.
+    Aliases shared by several short names are ambiguous and never resolved.
+    """
+    def __init__(self, items: typing.Sequence[BrainMetric | BrainDimension]) -> None:
+        self.exact: dict[str, str | None] = {}
+        self.normalized: dict[str, str | None] = {}
+        for item in items:
+            for alias in [item.short_name, *item.aliases]:
+                self.add(self.exact, alias.strip(), item.short_name)
+                self.add(self.normalized, normalize(alias), item.short_name)
+        self.entries = [
+            (alias, Counter(trigrams(alias)), short_name)
+            for alias, short_name in self.normalized.items()
+            if alias and short_name is not None
+        ]
+        self.postings: dict[str, list[int]] = {}
+        for i, (_, grams, _) in enumerate(self.entries):
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+
+    @staticmethod
+    def add(mapping: dict[str, str | None], alias: str, short_name: str) -> None:
+        if mapping.get(alias, short_name) != short_name:
+            mapping[alias] = None  # ambiguous
+        else:
+            mapping[alias] = short_name
+
+    def fuzzy(self, term: str) -> str | None:
+        grams = Counter(trigrams(term))
+        shared: Counter[int] = Counter()
+        for gram, count in grams.items():
+            for i in self.postings.get(gram, ()):
+                shared[i] += min(count, self.entries[i][1][gram])
+        total = sum(grams.values())
+        best, best_score = None, FUZZY_THRESHOLD
+        for i, common in shared.items():
+            score = 2 * common / (total + sum(self.entries[i][1].values()))
+            if score > best_score:
+                best, best_score = self.entries[i][2], score
+            elif score == best_score and best is not None and self.entries[i][2] != best:
+                best = None  # equally close to two different names
+        return best
+
+    def resolve(self, term: str) -> str | None:
+        if (short_name := self.exact.get(term.strip())) is not None:
+            return short_name
+        normalized = normalize(term)
+        if (short_name := self.normalized.get(normalized)) is not None:
+            return short_name
+        if not normalized:
+            return None
+        return self.fuzzy(normalized)
+
+
+_indexes: dict[str, tuple[list, AliasIndex]] = {}
+
+
+async def alias_index(resource: str) -> AliasIndex:
+    """
+    Alias index of the Brain metrics or dimensions, rebuilt only when the knowledgebase cache refreshes them.
+    If Brain is not available, the index is empty and all terms are left for the model.
+    """
+    try:
+        items = await knowledgebase.get(resource)
+    except Exception as err:
+        logger.warning(f"Brain {resource} are not available for translation: {err}")
+        return AliasIndex([])
+    cached = _indexes.get(resource)
+    if cached is None or cached[0] is not items:
+        cached = _indexes[resource] = (items, AliasIndex(items))
+        logger.info(f"Indexed {len(items)} Brain {resource} for translation")
+    return cached[1]
+
+
+def resolve_terms(index: AliasIndex, terms: list[str]) -> tuple[list[str | None], list[str]]:
+    """
+    Resolve the terms by the index, returns the resolved names (None for unknown terms)
+    and the list of the unknown terms.
+    """
+    resolved = [index.resolve(term) for term in terms]
+    unknown = [term for term, name in zip(terms, resolved) if name is None]
+    return resolved, unknown
+
+
+def merge_translations(terms: list[str], resolved: list[str | None], translated: list[str]) -> list[str]:
+    """
+    Fill the unknown terms by the translations, in order.
+    If the model returned fewer translations than asked for, the remaining terms are kept as they are.
+    """
+    remaining = iter(translated)
+    return [name if name is not None else next(remaining, term) for term, name in zip(terms, resolved)]
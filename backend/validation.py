@@ -0,0 +1,154 @@
+from celus_nibbler import Poop, NibblerError, eat
+from celus_nibbler.definitions import Definition
+from celus_nibbler.eat_and_poop import findparser, read_file
+from celus_nibbler.errors import MultipleParsersFound, NoParserFound
+from celus_nibbler.parsers.dynamic import gen_parser
+from celus_nibbler.reader import CsvSheetReader
+from collections import OrderedDict
+import typing
+import io
+import itertools
+import json
+import logging
+import os
+import pathlib
+import threading
+
+from flatten import flatten_records
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+VALIDATOR_CACHE_SIZE = int(os.environ.get("VALIDATOR_CACHE_SIZE", 8))  # validators kept by each worker process
+
+
+class LoadedSheet(typing.NamedTuple):
+    idx: int
+    name: str | None
+    text: str
+    dialect: typing.Any
+
+
+class ParserValidator:
+    """
+    Validates parser definitions against one file, kept by the worker process the file is assigned to (see parse_file).
+    The file is read (and XLSX converted to CSV) only once, each attempt then reads the sheets from memory.
+    Parsers generated from the definitions are cached, so an unchanged definition is not compiled again.
+    Before the full parse, a dry-run parses only a sample of records, so broken definitions fail fast.
+    """
+    PLATFORM = "val"
+
+    def __init__(self, path: str, sample_size: int = 50) -> None:
+        self.path = path
+        self.sample_size = sample_size
+        self.sheets: list[LoadedSheet] | None = None
+        self.parsers: dict[str, type] = {}
+
+    def load(self) -> list[LoadedSheet] | None:
+        """
+        Read the sheets into memory, returns None for formats whose readers cannot be re-created from CSV text.
+        """
+        if self.sheets is None:
+            sheets = []
+            for sheet in read_file(pathlib.Path(self.path)):
+                if not isinstance(sheet, CsvSheetReader):
+                    sheet.close()
+                    return None
+                sheet.file.seek(0)
+                sheets.append(LoadedSheet(sheet.sheet_idx, sheet.name, sheet.file.read(), sheet.dialect))
+                sheet.close()
+            logger.info(f"Loaded {len(sheets)} sheets of {self.path} for validation")
+            self.sheets = sheets
+        return self.sheets
+
+    def compile(self, dict_rules: dict) -> type:
+        key = json.dumps(dict_rules, sort_keys=True)
+        if key not in self.parsers:
+            self.parsers[key] = gen_parser(Definition.parse(dict_rules))
+        return self.parsers[key]
+
+    def eat(self, parser: type) -> list[Poop | NibblerError]:
+        """
+        Same as celus_nibbler.eat, but reading the sheets from memory.
+        """
+        sheets = self.load()
+        if sheets is None:
+            return eat(
+                file_path=self.path,
+                platform=self.PLATFORM,
+                check_platform=False,
+                parsers=[parser.name],
+                dynamic_parsers=[parser],
+            )
+        poops = []
+        for loaded in sheets:
+            sheet = CsvSheetReader(loaded.idx, loaded.name, io.StringIO(loaded.text), dialect=loaded.dialect)
+            try:
+                poops.append(Poop(findparser(
+                    sheet,
+                    self.PLATFORM,
+                    parsers=[parser.name],
+                    check_platform=False,
+                    dynamic_parsers=[parser],
+                )))
+            except (NoParserFound, MultipleParsersFound) as e:
+                poops.append(e)
+                sheet.close()
+        return poops
+
+    def dry_run(self, poop: Poop) -> None:
+        """
+        Parse only the first records, so that errors of the definition surface before the full parse.
+        """
+        records = poop.records(limit=self.sample_size)
+        if records is not None:
+            for _ in itertools.islice(records, self.sample_size):
+                pass
+
+    def parse(self, dict_rules: dict) -> Poop:
+        """
+        Parse the file using the definition and return the result of the first sheet.
+        Raises the parsing error if the definition does not match the first sheet.
+        """
+        parser = self.compile(dict_rules)
+        poop = self.eat(parser)[0]
+        if isinstance(poop, Exception):
+            raise poop
+        self.dry_run(poop)
+        return poop
+
+
+_validators: OrderedDict[tuple, ParserValidator] = OrderedDict()
+_validators_lock = threading.Lock()
+
+
+def get_validator(path: str) -> ParserValidator:
+    """
+    The validator of the file cached in this process, the least recently used ones are dropped over the limit.
+    Keyed by the size and modification time too, so a replaced file is loaded again.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    validator = _validators.get(key)
+    if validator is None:
+        validator = _validators[key] = ParserValidator(path)
+        while len(_validators) > VALIDATOR_CACHE_SIZE:
+            _validators.popitem(last=False)
+    _validators.move_to_end(key)
+    return validator
+
+
+def parse_file(path: str, string_json_parsing_rules: str) -> tuple[dict[str, list], dict]:
+    """
+    Parse the file into flattened columns and a summary of the stats (the stats themselves do not pickle).
+    CPU-bound, it is run in the worker process assigned to the file, so that the loaded sheets
+    and the compiled parsers of the previous attempts are reused.
+    """
+    # only the thread fallback of the process pool runs it concurrently
+    with _validators_lock:
+        poop = get_validator(path).parse(json.loads(string_json_parsing_rules))
+        records = poop.records_with_stats()
+        columns = flatten_records(records or [])
+    stats = poop.current_stats
+    summary = {"records": stats.total.count, "metrics": sorted(stats.metrics), "months": sorted(stats.months)}
+    return columns, summary
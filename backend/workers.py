@@ -1,11 +1,11 @@
+from abc import abstractmethod
 from base import FlowWorker
-from pydantic import BaseModel
-import requests
-from agents import Runner, Agent, function_tool, RunContextWrapper, ModelSettings
-import typing
+from agent_registry import agent_registry
+from agents import Agent, function_tool, RunContextWrapper, ModelSettings
 from prompts import (
     get_data_description_prompt,
     get_parsing_rules_prompt,
+    get_parsing_rules_task,
     get_translation_prompt,
     get_platform_prompt,
     get_gitlab_prompt,
@@ -21,13 +21,23 @@ from models import (
     UserInfoData,
 )
 from dataclasses import dataclass
+from brain import knowledgebase
+from jobs import ProgressHooks, report_progress, usage_summary
+from agent_cache import run_cached
+from telemetry import run_agent, telemetry
+from translation import alias_index, resolve_terms, merge_translations
+from sampling import DEFAULT_TOKEN_BUDGET
 from dotenv import load_dotenv
 import os
 import json
-from celus_nibbler.definitions import Definition
-from celus_nibbler.parsers.dynamic import gen_parser
-from celus_nibbler import eat
-import pandas as pd
+import asyncio
+import tempfile
+from storage import UPLOAD_DIR, StoredFile, store_file
+from validation import parse_file
+from offload import process_pool
+from layout import layout_fingerprint, layout_features
+from definitions import definition_cache
+from heuristics import propose_definitions
 import logging
 from utils.gitlab_client import GitLabClient, Issue
 
@@ -37,56 +47,31 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-class Platform(BaseModel):
-    short_name: str
-    name: str
-    provider: str | None = None
-    url: str | None = None
-
-class ParserDefinitionAPI(BaseModel):
-    parser_name: str
-    platforms: typing.List[str]
-
-
-class BrainMetric(BaseModel):
-    short_name: str
-    aliases: typing.List[str]
-
-class BrainDimension(BaseModel):
-    short_name: str
-    aliases: typing.List[str]
-
-class BrainClient():
-    def __init__(self):
-        self.token = os.environ.get('BRAIN_TOKEN')
-        self.base_url = "https://brain.celus.net/knowledgebase"
-
-    def get_metrics(self) -> typing.List[BrainMetric]:
-        url = f"{self.base_url}/metrics/"
-        headers = {
-            "Authorization": f"Token {self.token}"
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        return [BrainMetric.model_validate(m) for m in response.json()]
-
-    def get_dimensions(self) -> typing.List[BrainDimension]:
-        url = f"{self.base_url}/dimensions/"
-        headers = {
-            "Authorization": f"Token {self.token}"
-        }
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        return [BrainDimension.model_validate(d) for d in response.json()]
-
-class PlatformAgentWorker(FlowWorker):
-    def __init__(self):
-        self.agent = Agent(
+class AgentWorker(FlowWorker):
+    """
+    FlowWorker calling an agent.
+    The agent is built once by build_agent and shared through the agent registry,
+    the state of a run is kept in local variables or the context of the run, never in the worker or the agent.
+    """
+    @staticmethod
+    @abstractmethod
+    def build_agent() -> Agent:
+        raise NotImplementedError
+
+    @property
+    def agent(self) -> Agent:
+        return agent_registry.get(self.flow_worker_name())
+
+
+class PlatformAgentWorker(AgentWorker):
+    @staticmethod
+    def build_agent() -> Agent:
+        return Agent(
             name="Platform Agent",
             handoff_description="Specialist agent for questions about platforms.",
             instructions=get_platform_prompt(),
             model="gpt-4o-mini",
-            tools=[self.fetch_all_platforms],
+            tools=[PlatformAgentWorker.fetch_all_platforms],
             output_type=PlatformData,
         )
 
@@ -95,19 +80,9 @@ class PlatformAgentWorker(FlowWorker):
         """Fetch all available platforms from Brain API.
         Returns them in format platform_name(short_name)."""
 
-        url = "https://brain.celus.net/knowledgebase/platforms/"
-        headers = {
-            "Authorization": f"Token {os.environ.get('BRAIN_TOKEN')}"
-        }  # expects BRAIN_TOKEN in env
         logger.info("Fetching all platforms")
         try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            platforms = [Platform.model_validate(p) for p in response.json()]
-            return platforms
-        except requests.HTTPError as http_err:
-            logger.error(f"HTTP error occurred: {http_err}")
-            raise
+            return await knowledgebase.get("platforms")
         except Exception as err:
             logger.error(f"An error occurred: {err}")
             raise
@@ -117,17 +92,10 @@ class PlatformAgentWorker(FlowWorker):
         """Fetch all available parsers from Brain API.
         Returns them in format parser_name(platforms).
         """
-        url = "https://brain.celus.net/knowledgebase/parsers/"
-        headers = {"Authorization": f"Token {os.environ.get('BRAIN_TOKEN')}"}
         logger.info("Fetching all parsers")
         try:
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-            parsers = [ParserDefinitionAPI.model_validate(p) for p in response.json()]
+            parsers = await knowledgebase.get("parsers")
             return ",".join(f"Parser {p.parser_name}({p.platforms})" for p in parsers)
-        except requests.HTTPError as http_err:
-            logger.error(f"HTTP error occurred: {http_err}")
-            raise
         except Exception as err:
             logger.error(f"An error occurred: {err}")
             raise
@@ -139,16 +107,18 @@ class PlatformAgentWorker(FlowWorker):
     async def run(self, platform: PlatformData) -> set[PlatformData]:
         logger.info(f"Platform Agent: Checking platform {platform.platform_name}")
         prompt = f"I am interested in {platform.platform_name} platform."
-        result = await Runner.run(self.agent, prompt)
+        # the answer depends on the platforms returned by the tool, cached only until they change
+        result = await run_cached(self.agent, prompt, knowledgebase_resources=["platforms"], hooks=ProgressHooks())
         # create the PlatformData object
-        logger.info(f"Platform Agent result: {result.final_output}")
-        output = PlatformData.model_validate(result.final_output)
+        logger.info(f"Platform Agent result: {result}")
+        output = PlatformData.model_validate(result)
         return {output}
 
 
-class DataDescriptionWorker(FlowWorker):
-    def __init__(self):
-        self.agent = Agent(
+class DataDescriptionWorker(AgentWorker):
+    @staticmethod
+    def build_agent() -> Agent:
+        return Agent(
             name="Data Description Agent",
             handoff_description="Specialist agent for describing data.",
             instructions=get_data_description_prompt(),
@@ -170,7 +140,7 @@ class DataDescriptionWorker(FlowWorker):
         logger.info("Data Description worker: using file %s", file.file_name)
 
         # Base content from the prepared file (potentially multiple sheets)
-        content = file.to_llm_format()
+        content = file.to_llm_format(DEFAULT_TOKEN_BUDGET)
 
         # If user provided a comment, prepend it to the content sent to the agent
         if user_info.user_comment:
@@ -183,15 +153,16 @@ class DataDescriptionWorker(FlowWorker):
                 f"{content}"
             )
 
-        result = await Runner.run(self.agent, content)
+        result = await run_cached(self.agent, content, hooks=ProgressHooks())
         logger.info("Data Description Agent result:")
-        logger.info(result.final_output)
-        return {result.final_output}
+        logger.info(result)
+        return {result}
 
 
-class TranslationWorker(FlowWorker):
-    def __init__(self):
-        self.agent = Agent(
+class TranslationWorker(AgentWorker):
+    @staticmethod
+    def build_agent() -> Agent:
+        return Agent(
             name="Translation Agent",
             handoff_description="Agent for metric and dimension translations.",
             instructions=get_translation_prompt(),
@@ -208,15 +179,36 @@ class TranslationWorker(FlowWorker):
         dimensions = data_description.dimensions
         logger.info("Translation worker: metrics: %s", metrics)
         logger.info("Translation worker: dimensions: %s", dimensions)
-        input = f"""Metrics: {metrics},Dimensions: {dimensions}"""
-        result = await Runner.run(self.agent, input)
-        logger.info("Translation Agent result:")
-        logger.info(result.final_output)
-        return {result.final_output}
-
-class GitlabWorker(FlowWorker):
-    def __init__(self):
-        self.agent = Agent(
+
+        # terms known to Brain (by name or alias) are translated locally, only the rest goes to the model
+        resolved_metrics, unknown_metrics = resolve_terms(await alias_index("metrics"), metrics)
+        resolved_dimensions, unknown_dimensions = resolve_terms(await alias_index("dimensions"), dimensions)
+        logger.info(
+            "Translation worker: %d of %d terms resolved locally",
+            len(metrics) + len(dimensions) - len(unknown_metrics) - len(unknown_dimensions),
+            len(metrics) + len(dimensions),
+        )
+        translated = TranslationData(metrics_translations=[], dimensions_translations=[])
+        if unknown_metrics or unknown_dimensions:
+            input = f"""Metrics: {unknown_metrics},Dimensions: {unknown_dimensions}"""
+            translated = await run_cached(self.agent, input, hooks=ProgressHooks())
+            logger.info("Translation Agent result:")
+            logger.info(translated)
+        result = TranslationData(
+            metrics_translations=merge_translations(
+                metrics, resolved_metrics, translated.metrics_translations
+            ),
+            dimensions_translations=merge_translations(
+                dimensions, resolved_dimensions, translated.dimensions_translations
+            ),
+        )
+        return {result}
+
+
+class GitlabWorker(AgentWorker):
+    @staticmethod
+    def build_agent() -> Agent:
+        return Agent(
             name="Gitlab Issue Agent",
             handoff_description="Agent for fetching information from Gitlab issue.",
             instructions=get_gitlab_prompt(),
@@ -228,135 +220,154 @@ class GitlabWorker(FlowWorker):
     def flow_worker_name():
         return "gitlab_worker"
 
-    async def run(self, user_info: UserInfoData) -> set[PlatformData | FileData]:
-        issue_iid = user_info.gitlab_issue
-        if issue_iid is None:
-            return {PlatformData(platform_name="", short_name="", provider=None, url=None)}
-
-        # Fetch issue manually
-        logger.info(f"Fetching Gitlab issue {issue_iid}")
-        client = GitLabClient(
+    @staticmethod
+    def client() -> GitLabClient:
+        return GitLabClient(
             token=os.environ.get("GITLAB_API_TOKEN"),
             project_id=os.environ.get("GITLAB_PROJECT_ID")
         )
-        issue: Issue = client.get_issue(issue_iid)
-        client.download_files(issue.get_file_paths(), destination_folder="uploaded_files")
-    
-        # Prepare content for the agent
-        issue_content = issue.model_dump_json()
-        
-        # Run agent with issue content directly
-        result = await Runner.run(self.agent, issue_content)
-        output = PlatformData.model_validate(result.final_output)
-        
-        file_data = None
-        paths = issue.get_file_paths()
-        if paths:
-            # Take the first file for now
-            filename = paths[0].split('/')[-1]
-            file_path = os.path.join("uploaded_files", filename)
-            if os.path.exists(file_path):
-                
+
+    @staticmethod
+    async def store_attachments(client: GitLabClient, paths: list[str]) -> list[StoredFile | None]:
+        """
+        Download the attachments of the issue once and store them in the content-addressed storage.
+        They are downloaded into a private temporary directory, so concurrent runs never share a file.
+        The result is aligned with the paths, attachments of unsupported formats (or not downloaded) are None.
+        """
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=UPLOAD_DIR) as directory:
+            await asyncio.to_thread(client.download_files, paths, destination_folder=directory)
+            stored: list[StoredFile | None] = []
+            for path in paths:
+                file_name = path.split('/')[-1]
+                file_path = os.path.join(directory, file_name)
                 try:
-                    file_format = FileFormat.from_file_extension(filename)
-                    file_data = FileData(path=file_path, format=file_format)
+                    FileFormat.from_file_extension(file_name)
                 except ValueError:
-                    logger.warning(f"Could not determine file format for {filename}")
+                    logger.warning(f"Could not determine file format for {file_name}")
+                    stored.append(None)
+                    continue
+                stored.append(await store_file(file_path, file_name) if os.path.exists(file_path) else None)
+        return stored
+
+    async def resolve_issue(self, issue_iid: int) -> tuple[PlatformData, list[StoredFile | None]]:
+        """
+        Find the platform of the issue by the agent and store its attachments (see store_attachments).
+        Batches resolve every issue once and process its attachments separately.
+        """
+        logger.info(f"Fetching Gitlab issue {issue_iid}")
+        client = self.client()
+        issue: Issue = await asyncio.to_thread(client.get_issue, issue_iid)
+        attachments = await self.store_attachments(client, issue.get_file_paths())
+
+        # Run agent with issue content directly
+        result = await run_agent(self.agent, issue.model_dump_json(), hooks=ProgressHooks())
+        return PlatformData.model_validate(result.final_output), attachments
 
-        if file_data:
+    async def run(self, user_info: UserInfoData) -> set[PlatformData | FileData]:
+        issue_iid = user_info.gitlab_issue
+        if issue_iid is None:
+            # nothing to fetch, the platform given by the user is kept
+            return set()
+
+        output, attachments = await self.resolve_issue(issue_iid)
+        # Take the selected attachment, the first one by default
+        if user_info.gitlab_attachment < len(attachments) and (stored := attachments[user_info.gitlab_attachment]):
+            file_data = await FileData.prepared(
+                path=stored.path,
+                format=FileFormat.from_file_extension(stored.file_name),
+                file_name=stored.file_name,
+                content_hash=stored.content_hash,
+            )
             return {output, file_data}
         return {output}
 
-class ParsingRulesWorker(FlowWorker):
+class ParsingRulesWorker(AgentWorker):
     @dataclass
     class Context:
-        # necessary for sharing the information to the function tools, which cannot have self argument
+        # state of one run, shared with the function tools and the instructions of the agent
+        task: str = ""  # part of the prompt describing the file
         parser_definition: ParserDefinitionData | None = None
+        parsing_rules: str | None = None  # JSON of the parser definition as it passed the check
         parsed_data: ParsedData | None = None
         file_path: str | None = None
+        attempts: int = 0
 
-    def __init__(self):
-        self.agent = Agent[self.Context](
+    @staticmethod
+    def build_agent() -> Agent:
+        return Agent[ParsingRulesWorker.Context](
             name="Parsing Rules Agent",
             handoff_description="Specialist agent for parsing rules.",
+            instructions=ParsingRulesWorker.instructions,
             model="gpt-5.1",
-            model_settings=ModelSettings(reasoning={"effort": "medium"}),
-            tools=[self.check_parsing_rules],
+            model_settings=ModelSettings(
+                reasoning={"effort": "medium"},
+                # requests sharing the static prompt prefix are routed to the same prompt cache
+                extra_args={"prompt_cache_key": "parsing_rules"},
+            ),
+            tools=[ParsingRulesWorker.check_parsing_rules],
         )
-        self.context = self.Context()
 
     @staticmethod
-    def flow_worker_name():
-        return "parsing_rules_worker"
+    def instructions(wrapper: RunContextWrapper[Context], agent: Agent) -> str:
+        """
+        The static prompt followed by the task of the run, so that the provider can cache the static prefix.
+        """
+        return f"{get_parsing_rules_prompt()}\n{wrapper.context.task}"
 
     @staticmethod
-    def parse_data(string_json_parsing_rules: str, filename: str) -> pd.DataFrame | str:
-        """Try to parse the data using the parsing rules."""
-        dict_rules = json.loads(string_json_parsing_rules)
-        parser_definition = Definition.parse(dict_rules)
-
-        dynamic_parsers = [gen_parser(parser_definition)]
-
-        poops = eat(
-            file_path=filename,
-            platform="val",
-            check_platform=False,
-            parsers=[e.name for e in dynamic_parsers],
-            dynamic_parsers=dynamic_parsers,
-        )
-
-        poops[0].records_with_stats()
-        df = pd.DataFrame(poops[0].records())
-
-        # drop item_ids column
-        df = df.drop(columns=["item_ids"], errors="ignore")
-
-        # dimension data is dict, divide it into columns
-        for col in df.columns:
-            if isinstance(df[col].iloc[0], dict):
-                # create new columns for each key in the dict
-                dict_df = pd.json_normalize(df[col])
-                # rename the columns to include the original column name
-                dict_df.columns = [f"{col}.{k}" for k in dict_df.columns]
-                # concatenate the new columns with the original dataframe
-                df = pd.concat([df, dict_df], axis=1)
-                # drop the original column
-                df = df.drop(columns=[col])
-
-        # keep only non None columns
-        df = df.dropna(axis=1, how="all")
-        # save the csv into uploaded_files folder
-        df.to_csv(
-            os.path.join("uploaded_files", f"{filename.split('/')[-1]}_parsed.csv"),
-            index=False,
-        )
-        return df
+    def flow_worker_name():
+        return "parsing_rules_worker"
 
     @staticmethod
-    @function_tool
-    def check_parsing_rules(
-        wrapper: RunContextWrapper[Context], string_json_parsing_rules: str
-    ) -> bool | str:
-        """Check whether the generated parser rules conform to the expected format."""
+    async def apply_parsing_rules(context: Context, string_json_parsing_rules: str) -> bool | str:
+        """
+        Validate the parsing rules and parse the file with them.
+        On success the definition and the parsed data are stored in the context and True is returned,
+        otherwise the error message.
+        The file is parsed by the worker process assigned to it, which keeps it loaded between the attempts,
+        so other sessions are not blocked meanwhile.
+        """
+        context.attempts += 1
         dict_rules = json.loads(string_json_parsing_rules)
         # validate against parser definiton:
         try:
             ParserDefinitionData.model_validate(dict_rules)
-            df = ParsingRulesWorker.parse_data(
-                string_json_parsing_rules, filename=wrapper.context.file_path
+            columns, summary = await process_pool.run_keyed(
+                context.file_path, parse_file, context.file_path, string_json_parsing_rules
             )
-            parsed_data = ParsedData(columns=[], rows=[])
-            parsed_data.from_df(df)
-            wrapper.context.parsed_data = parsed_data
-            wrapper.context.parser_definition = ParserDefinitionData.model_validate(
+            parsed_data = ParsedData(columns=[])
+            parsed_data.from_columns(columns)
+            context.parsed_data = parsed_data
+            context.parser_definition = ParserDefinitionData.model_validate(
                 dict_rules
             )
+            context.parsing_rules = string_json_parsing_rules
         except Exception as e:
             logger.exception(e)
+            report_progress(
+                "check_parsing_rules", attempt=context.attempts, success=False, error=str(e)
+            )
             return str(e)
 
+        report_progress(
+            "check_parsing_rules",
+            attempt=context.attempts,
+            success=True,
+            **summary,
+        )
         return True
 
+    @staticmethod
+    @function_tool
+    async def check_parsing_rules(
+        wrapper: RunContextWrapper[Context], string_json_parsing_rules: str
+    ) -> bool | str:
+        """Check whether the generated parser rules conform to the expected format."""
+        # only the checks called by the agent, the cached and heuristic definitions are counted apart
+        telemetry.add("check_parsing_rules")
+        return await ParsingRulesWorker.apply_parsing_rules(wrapper.context, string_json_parsing_rules)
+
     async def run(
         self,
         data_description: DataDescriptionData,
@@ -364,7 +375,39 @@ class ParsingRulesWorker(FlowWorker):
         file: FileData,
         user_info: UserInfoData,
     ) -> set[ParserDefinitionData, ParsedData]:
-        self.agent.instructions = get_parsing_rules_prompt(
+        logger.info("USER COMMENT: %s", user_info.user_comment)
+        context = self.Context(file_path=file.path)
+
+        # a file of the same layout was already parsed, try its definition first
+        fingerprint = layout_fingerprint(file)
+        cached = definition_cache.get(fingerprint)
+        if cached is not None:
+            telemetry.add("definition_cache_checks")
+            if await self.apply_parsing_rules(context, cached) is True and context.parsed_data.row_count:
+                logger.info(f"Using cached parser definition for layout {fingerprint[:12]}")
+                definition_cache.hit(fingerprint)
+                report_progress("definition_cache", hit=True)
+                return {context.parser_definition, context.parsed_data}
+            logger.info(f"Cached parser definition for layout {fingerprint[:12]} does not fit the file")
+            context.parser_definition = context.parsing_rules = context.parsed_data = None
+        report_progress("definition_cache", hit=False)
+        features = layout_features(file, data_description.metrics)
+
+        # simple layouts are recognized by the heuristics without calling the model
+        for proposal in propose_definitions(file, data_description):
+            telemetry.add("heuristic_checks")
+            if await self.apply_parsing_rules(context, proposal) is True and context.parsed_data.row_count:
+                logger.info("Using parser definition proposed by the heuristics")
+                report_progress("heuristics", success=True)
+                definition_cache.put(fingerprint, proposal, features)
+                return {context.parser_definition, context.parsed_data}
+            context.parser_definition = context.parsing_rules = context.parsed_data = None
+        report_progress("heuristics", success=False)
+
+        # definitions of similar layouts are given to the agent as starting points
+        examples = definition_cache.similar(features, exclude=fingerprint)
+        logger.info(f"Found {len(examples)} parser definitions of similar layouts")
+        context.task = get_parsing_rules_task(
             data_description.metrics,
             data_description.dimensions,
             data_description.begin_month_year,
@@ -373,12 +416,14 @@ class ParsingRulesWorker(FlowWorker):
             data_description.title_identifiers,
             platform.platform_name,
             user_info.user_comment,
+            examples,
         )
-        logger.info("USER COMMENT: %s", user_info.user_comment)
-        content = file.to_llm_format()
-        self.context.file_path = file.path #todo name more reasonably
-        await Runner.run(self.agent, content, context=self.context)
-        return {self.context.parser_definition, self.context.parsed_data}
+        content = file.to_llm_format(DEFAULT_TOKEN_BUDGET)
+        result = await run_agent(self.agent, content, context=context, hooks=ProgressHooks())
+        logger.info(f"Parsing rules agent usage: {usage_summary(result.context_wrapper.usage)}")
+        if context.parsing_rules is not None:
+            definition_cache.put(fingerprint, context.parsing_rules, features)
+        return {context.parser_definition, context.parsed_data}
 
 
 FLOW_WORKERS: set[type[FlowWorker]] = {
@@ -388,3 +433,6 @@ FLOW_WORKERS: set[type[FlowWorker]] = {
     TranslationWorker,
     GitlabWorker
 }
+
+for worker in FLOW_WORKERS:
+    agent_registry.register(worker.flow_worker_name(), worker.build_agent)
@@ -16,6 +16,22 @@ const getState = async (sessionId: number, stateName: string) => {
   }
 }
 
+const getParsedData = async (
+  sessionId: number,
+  offset = 0,
+  limit = 100,
+  sortBy: string | null = null,
+  descending = false,
+) => {
+  // the parsed data is served page by page, sorted on the backend
+  const params: Record<string, any> = { offset, limit, descending }
+  if (sortBy) {
+    params.sort_by = sortBy
+  }
+  const response = await axios_client.get(`parsed_data/${sessionId}`, { params })
+  return response.data
+}
+
 const setState = async (sessionId: number, stateName: string, valuesDict: any) => {
   console.log('Setting state:', stateName)
   try {
@@ -26,19 +42,28 @@ const setState = async (sessionId: number, stateName: string, valuesDict: any) =
   }
 }
 
-const callWorker = async (sessionId: number, workerName: string) => {
+const callWorker = async (sessionId: number, workerName: string, pollInterval = 1000) => {
   console.log('Calling worker')
   try {
-    const response = await axios_client.get(`worker/${sessionId}/${workerName}`)
-    console.log('Response from backend:', response)
-    return response.data
+    // the worker runs as a background job, poll its status until it finishes
+    const submitted = await axios_client.post(`jobs/${sessionId}/${workerName}`)
+    console.log('Job submitted:', submitted.data)
+    let job = submitted.data
+    while (!['succeeded', 'failed', 'cancelled'].includes(job.status)) {
+      await new Promise((resolve) => setTimeout(resolve, pollInterval))
+      job = (await axios_client.get(`jobs/${job.job_id}`)).data
+    }
+    console.log('Job finished:', job)
+    if (job.status !== 'succeeded') {
+      throw new Error(`Worker ${workerName} ${job.status}: ${job.error}`)
+    }
+    return job
   } catch (error) {
     console.error('Error calling worker:', error)
     throw error
   }
 }
 
-
 export interface BrainMetric {
   short_name: string
   aliases: string[]
@@ -97,4 +122,12 @@ const getBrainDimensions = async () => {
   }
 }
 
-export { axios_client, getState, setState, callWorker, getBrainMetrics, getBrainDimensions }
+export {
+  axios_client,
+  getState,
+  getParsedData,
+  setState,
+  callWorker,
+  getBrainMetrics,
+  getBrainDimensions,
+}